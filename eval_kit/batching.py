@@ -0,0 +1,250 @@
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+from eval_kit.metrics import metrics
+
+
+def _parse_size(value):
+    if not value:
+        return None
+    width, height = value.lower().replace('x', ',').split(',')
+    return int(width), int(height)
+
+
+# Resize every image to (width, height) when it is decoded, e.g. CELEBASPOOF_INGEST_SIZE=224x224,
+# so that every batch is one contiguous array. By default images keep their size.
+INGEST_SIZE = _parse_size(os.environ.get('CELEBASPOOF_INGEST_SIZE'))
+# Memory budget of one batch in bytes: its decoded images plus the activations of the model
+# while scoring it. Batches are cut short to fit, 0 only applies the fixed batch size.
+MEMORY_BUDGET = int(os.environ.get('CELEBASPOOF_MEMORY_BUDGET', 0))
+# Memory used per image inside predict: the preprocessed float input and the peak
+# activations of a ResNet-18 at 224x224.
+ACTIVATION_BYTES = int(os.environ.get('CELEBASPOOF_ACTIVATION_BYTES', 8 * 1024 * 1024))
+# Probe the detector at start-up and use the fastest batch size that fits the budget.
+AUTOTUNE = os.environ.get('CELEBASPOOF_AUTOTUNE', '0') != '0'
+AUTOTUNE_CANDIDATES = (8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class BatchPolicy(object):
+    """
+    Decides how many images go into one batch: at most max_batch_size, and no more than
+    memory_budget allows given the decoded image sizes and activation_bytes.
+    The policy can be shared with a running image iterator, changes apply to the next batches.
+    """
+
+    def __init__(self, max_batch_size, memory_budget=MEMORY_BUDGET, activation_bytes=ACTIVATION_BYTES):
+        self.max_batch_size = max_batch_size
+        self.memory_budget = memory_budget
+        self.activation_bytes = activation_bytes
+
+    def image_bytes(self, shape):
+        return int(np.prod(shape)) + self.activation_bytes
+
+    def batch_size(self, shape):
+        if not self.memory_budget:
+            return self.max_batch_size
+        fits = self.memory_budget // self.image_bytes(shape)
+        return int(max(1, min(self.max_batch_size, fits)))
+
+    def fits(self, count, batch_bytes, shape):
+        """
+        Whether an image of shape can join a batch of count images taking batch_bytes (see image_bytes).
+        """
+        if count >= self.max_batch_size:
+            return False
+        return not self.memory_budget or batch_bytes + self.image_bytes(shape) <= self.memory_budget
+
+    def autotune(self, detector, shape=(224, 224, 3), candidates=AUTOTUNE_CANDIDATES, repeat=2):
+        """
+        Time detector.predict on synthetic batches of every candidate size that fits the memory
+        budget, and use the fastest one as max_batch_size. Run it before the image iterator
+        starts, its threads would skew the timings.
+
+        return:
+        - dict of batch size -> images per second
+        """
+        rng = np.random.RandomState(0)
+        results = {}
+        # probe runs are not part of the job, keep them out of the metrics report
+        with metrics.muted():
+            for batch_size in candidates:
+                if self.memory_budget and batch_size * self.image_bytes(shape) > self.memory_budget:
+                    break
+                images = rng.randint(0, 256, (batch_size,) + tuple(shape)).astype(np.uint8)
+                try:
+                    detector.predict(images)
+                    st = time.time()
+                    for _ in range(repeat):
+                        detector.predict(images)
+                except (RuntimeError, MemoryError):
+                    logging.info("Batch size {} failed, stopping the autotune".format(batch_size))
+                    break
+                results[batch_size] = batch_size * repeat / (time.time() - st)
+                logging.info("Autotune batch size {}: {:.1f} images/s".format(batch_size, results[batch_size]))
+        if results:
+            self.max_batch_size = max(results, key=results.get)
+            logging.info("Autotune picked batch size {}".format(self.max_batch_size))
+        return results
+
+    def __repr__(self):
+        return 'BatchPolicy(max_batch_size={}, memory_budget={}, activation_bytes={})'.format(
+            self.max_batch_size, self.memory_budget, self.activation_bytes)
+
+
+def buffer_slots(prefetch_depth=None):
+    """
+    Number of batch arenas a BatchBuffer recycles so that no batch is overwritten while in use.
+
+    params:
+    - prefetch_depth (int): depth of the PrefetchIterator the batches are handed to, None when
+      every batch is copied as it is yielded (see copy_batch)
+    """
+    if prefetch_depth is None:
+        # the batch just closed, until it is copied, and the batch being filled
+        return 2
+    # the batch being scored, the prefetch queue, the batch the prefetch thread holds while the
+    # queue is full, and the batch being filled: reserve writes the next image before the
+    # batch it closed is yielded
+    return max(1, prefetch_depth) + 3
+
+
+def copy_batch(images):
+    """
+    Copy a batch out of the arena of a BatchBuffer, for consumers keeping batches around.
+    """
+    if isinstance(images, list):
+        return [image.copy() for image in images]
+    return images.copy()
+
+
+def _allocate(shape):
+    return np.empty(shape, dtype=np.uint8)
+
+
+class BatchBuffer(object):
+    """
+    Assemble images into uint8 batches without per-batch allocation. Every image is written
+    straight into a preallocated arena, one of slots arenas reused in turn: a returned batch
+    stays valid until slots - 1 more batches have been returned (see buffer_slots).
+
+    Batches keep the input order and may mix image shapes. A batch whose images share one
+    shape, e.g. with ingest_size set or a list of same-size crops, is a contiguous array of
+    shape (N, H, W, 3). Otherwise it is a list of (H, W, 3) arrays, which the detector groups
+    by shape itself (see AENetPredictor.preprocess_batch).
+
+    batch_size is either a fixed number of images or a BatchPolicy sizing batches by their memory,
+    whose budget then also bounds the size of every arena.
+    allocator(shape) returns the uint8 array backing an arena, e.g. one in shared memory.
+    """
+
+    def __init__(self, batch_size, ingest_size=INGEST_SIZE, slots=buffer_slots(), allocator=_allocate):
+        self.policy = batch_size if isinstance(batch_size, BatchPolicy) else BatchPolicy(batch_size, memory_budget=0)
+        self.allocator = allocator
+        self.ingest_size = ingest_size
+        self._arenas = [None] * slots
+        self._slot = 0
+        self._arena = None
+        self._offset = 0
+        self._ids = []
+        self._views = []
+        self._bytes = 0
+
+    def batch_shape(self, height, width):
+        """
+        Return the shape an image of height x width takes in a batch.
+        """
+        if self.ingest_size is not None:
+            width, height = self.ingest_size
+        return height, width, 3
+
+    def _next_view(self, shape):
+        nbytes = int(np.prod(shape))
+        if self._arena is None or self._offset + nbytes > len(self._arena):
+            arena = self._arenas[self._slot]
+            size = nbytes * self.policy.batch_size(shape)
+            if self._arena is not None:
+                # a batch of larger images moves on to a bigger arena, its first images stay
+                # valid in the previous one
+                arena = None
+                size = max(size, 2 * len(self._arena))
+                if self.policy.memory_budget:
+                    # the images of a batch never take more than the budget
+                    size = max(nbytes, min(size, self.policy.memory_budget))
+            if arena is None or len(arena) < size:
+                arena = self.allocator((size,))
+                self._arenas[self._slot] = arena
+            self._arena = arena
+            self._offset = 0
+        view = self._arena[self._offset:self._offset + nbytes].reshape(shape)
+        self._offset += nbytes
+        return view
+
+    def _take(self):
+        ids = np.array(self._ids)
+        batch = self._views
+        shape = batch[0].shape
+        if self._offset == len(batch) * batch[0].nbytes and all(view.shape == shape for view in batch):
+            # one shape, written back to back from the start of the current arena
+            batch = self._arena[:self._offset].reshape((len(batch),) + shape)
+        self._slot = (self._slot + 1) % len(self._arenas)
+        self._arena = None
+        self._offset = 0
+        self._ids = []
+        self._views = []
+        self._bytes = 0
+        return ids, batch
+
+    def reserve(self, image_id, shape):
+        """
+        Reserve the slot of an image in the current batch, for writers that fill it later.
+        A batch returned as ready may include reserved slots, it must not be used before they are written.
+
+        params:
+        - image_id (str)
+        - shape (tuple): (H, W, 3) from batch_shape
+        return:
+        - view (np.array): the slot to write the RGB image into
+        - list of (image_id: numpy.array, images: numpy.array or list) batches that are ready
+        """
+        ready = []
+        if self._ids and not self.policy.fits(len(self._ids), self._bytes, shape):
+            ready.append(self._take())
+        view = self._next_view(shape)
+        self._ids.append(image_id)
+        self._views.append(view)
+        self._bytes += self.policy.image_bytes(shape)
+        if len(self._ids) >= self.policy.max_batch_size:
+            ready.append(self._take())
+        return view, ready
+
+    def add(self, image_id, image):
+        """
+        Copy an image into the buffer.
+
+        params:
+        - image_id (str)
+        - image (np.array): RGB image of shape (H, W, 3)
+        return:
+        - list of (image_id: numpy.array, images: numpy.array or list) batches that are ready
+        """
+        shape = self.batch_shape(*image.shape[:2])
+        view, ready = self.reserve(image_id, shape)
+        if image.shape == shape:
+            view[...] = image
+        else:
+            resized = cv2.resize(image, self.ingest_size, dst=view, interpolation=cv2.INTER_AREA)
+            if resized is not view:
+                view[...] = resized
+        return ready
+
+    def flush(self):
+        """
+        Return the remaining partial batch.
+        """
+        if not self._ids:
+            return []
+        return [self._take()]
@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Directory of the persistent prediction cache, caching is off unless it is set.
+CACHE_DIR = os.environ.get('CELEBASPOOF_CACHE_DIR')
+# Size budget of the on-disk tier, the least recently used entries are evicted beyond it.
+CACHE_MAX_BYTES = int(os.environ.get('CELEBASPOOF_CACHE_MAX_BYTES', 1 << 30))
+# Number of entries kept in the in-memory LRU tier.
+CACHE_MEMORY_ENTRIES = int(os.environ.get('CELEBASPOOF_CACHE_MEMORY_ENTRIES', 1 << 20))
+
+
+def file_fingerprint(*paths, **kwargs):
+    """
+    Fingerprint of a model: a hash of the content of its weight files plus any extra config.
+
+    params:
+    - paths (str): files the predictions depend on, e.g. the checkpoint
+    - extra (str): anything else that changes the predictions, e.g. the predictor mode
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(kwargs.get('extra', '').encode('utf-8'))
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    Cache of spoof probabilities keyed by the hash of the encoded image bytes and a model
+    fingerprint, so images already scored by the same model skip decode and inference.
+    Entries live in an in-memory LRU in front of an sqlite file with size-based eviction.
+
+    The image iterator calls lookup() with the downloaded bytes: hits are kept aside and
+    returned by pop_hits(), misses are remembered until store() receives their scores.
+    """
+
+    def __init__(self, fingerprint, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES,
+                 memory_entries=CACHE_MEMORY_ENTRIES):
+        self.fingerprint = fingerprint.encode('utf-8')
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._hit_probs = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'predictions.sqlite')
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                         '(key TEXT PRIMARY KEY, prob REAL NOT NULL, atime REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS predictions_atime ON predictions (atime)')
+        self._db.commit()
+
+    def key(self, data):
+        return hashlib.sha256(self.fingerprint + data).hexdigest()
+
+    def _remember(self, key, prob):
+        self._memory[key] = prob
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        row = self._db.execute('SELECT prob FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute('UPDATE predictions SET atime = ? WHERE key = ?', (time.time(), key))
+        self._remember(key, row[0])
+        return row[0]
+
+    def lookup(self, image_id, data):
+        """
+        Look up the encoded image data of image_id.
+
+        return:
+        - the cached spoof probability, or None when the image has to be scored
+        """
+        key = self.key(data)
+        with self._lock:
+            prob = self._get(key)
+            if prob is None:
+                self.misses += 1
+                self._pending[image_id] = key
+            else:
+                self.hits += 1
+                self._hit_probs[image_id] = prob
+        return prob
+
+    def store(self, image_ids, probs):
+        """
+        Save the spoof probabilities of images previously missed by lookup().
+        """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for image_id, prob in zip(image_ids, probs):
+                key = self._pending.pop(image_id, None)
+                if key is None:
+                    continue
+                prob = float(prob)
+                self._remember(key, prob)
+                rows.append((key, prob, now))
+            self._db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)', rows)
+            self._db.commit()
+            self._evict()
+
+    def _disk_bytes(self):
+        page_size, = self._db.execute('PRAGMA page_size').fetchone()
+        page_count, = self._db.execute('PRAGMA page_count').fetchone()
+        free_count, = self._db.execute('PRAGMA freelist_count').fetchone()
+        return (page_count - free_count) * page_size
+
+    def _evict(self):
+        size = self._disk_bytes()
+        if size <= self.max_bytes:
+            return
+        count, = self._db.execute('SELECT COUNT(*) FROM predictions').fetchone()
+        # drop the oldest entries down to 90% of the budget
+        n = int(count * (1 - 0.9 * self.max_bytes / float(size))) + 1
+        self._db.execute('DELETE FROM predictions WHERE key IN '
+                         '(SELECT key FROM predictions ORDER BY atime LIMIT ?)', (n,))
+        self._db.commit()
+        self._db.execute('PRAGMA incremental_vacuum')
+        self.evictions += n
+
+    def pop_hits(self):
+        """
+        Return and forget the {image_id: prob} of the cache hits seen so far.
+        """
+        with self._lock:
+            hits, self._hit_probs = self._hit_probs, {}
+        return hits
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(total) if total else 0.0,
+            'evictions': self.evictions,
+            'memory_entries': len(self._memory),
+            'disk_bytes': self._disk_bytes(),
+        }
+
+    def log_stats(self):
+        logging.info("Prediction cache stats: {}".format(self.stats()))
+
+    def close(self):
+        self._db.close()
@@ -3,19 +3,27 @@ import json
 import cv2
 import os
 import time
-import sys
+import threading
+
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import logging
-import zipfile
-try:
-    import zlib
-    compression = zipfile.ZIP_DEFLATED
-except:
-    compression = zipfile.ZIP_STORED
 
 import numpy as np
 
-from io import BytesIO
+from eval_kit.batching import BatchBuffer, BatchPolicy, INGEST_SIZE, buffer_slots, copy_batch
+from eval_kit.decode_pool import open_decode_pool, peek_image_size, reduced_decode, REDUCED_DECODE
+from eval_kit.journal import EvalJournal, JOURNAL_DIR
+from eval_kit.local_s3 import LocalS3Client
+from eval_kit.metrics import metrics
+from eval_kit.output import OutputWriter, S3MultipartSink
+from eval_kit.packs import PACK_INDEX, PackedStorage
+from eval_kit.sharding import ShardBoard, board_key
+from eval_kit.storage import LocalStorage, S3Storage
+from eval_kit.tensor_store import TENSOR_STORE_DIR, TensorStore
 
 
 # EVALUATION SYSTEM SETTINGS
@@ -37,62 +45,211 @@ LOCAL_ROOT = '/'
 LOCAL_IMAGE_LIST_PATH = 'test_data/test_example.txt'
 LOCAL_LABEL_LIST_PATH = 'test_data/test_example_label.json'
 
+# Number of concurrent image downloads, sharing one S3 client and its connection pool.
+FETCH_WORKERS = int(os.environ.get('CELEBASPOOF_FETCH_WORKERS', 16))
+# Point the S3 client at a local stand-in (e.g. minio or moto server) instead of AWS.
+S3_ENDPOINT_URL = os.environ.get('CELEBASPOOF_S3_ENDPOINT_URL')
+# Serve the buckets from this directory with eval_kit.local_s3.LocalS3Client instead of S3.
+LOCAL_S3_ROOT = os.environ.get('CELEBASPOOF_LOCAL_S3_ROOT')
+# Where get_image reads the image list and the images from: 's3', the workspace bucket, or
+# 'local', a directory laid out like the bucket at STORAGE_ROOT (see eval_kit.storage).
+STORAGE = os.environ.get('CELEBASPOOF_STORAGE', 's3')
+STORAGE_ROOT = os.environ.get('CELEBASPOOF_STORAGE_ROOT', '.')
+# 'json' is the format read by the evaluation server, 'compact' stores ids plus float32 scores.
+OUTPUT_FORMAT = os.environ.get('CELEBASPOOF_OUTPUT_FORMAT', 'json')
+OUTPUT_COMPRESS = os.environ.get('CELEBASPOOF_OUTPUT_COMPRESS', '0') != '0'
+# Mirror the evaluation journal to JOURNAL_PREFIX of the workspace bucket, so a job can resume on another container.
+JOURNAL_S3 = os.environ.get('CELEBASPOOF_JOURNAL_S3', '0') != '0'
+JOURNAL_PREFIX = 'journal/'
+# Score the job as this node of a sharded evaluation (see eval_kit.sharding), unset scores it all on one node.
+SHARD_NODE = os.environ.get('CELEBASPOOF_SHARD_NODE')
+# The coordinator node also merges the shard outputs into the job output once every shard is done.
+SHARD_COORDINATOR = os.environ.get('CELEBASPOOF_SHARD_COORDINATOR', '0') != '0'
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def _get_s3_client():
+    """
+    Return the S3 client shared by the whole process, creating it on first use.
+    boto3 clients are thread safe, so every download reuses the same client and its
+    connection pool, which is sized to serve FETCH_WORKERS concurrent requests.
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None and LOCAL_S3_ROOT:
+            _s3_client = LocalS3Client(LOCAL_S3_ROOT)
+        if _s3_client is None:
+            config = Config(max_pool_connections=max(FETCH_WORKERS, 10))
+            _s3_client = boto3.client('s3', region_name='us-west-2',
+                                      endpoint_url=S3_ENDPOINT_URL, config=config)
+    return _s3_client
+
+
+def set_s3_client(s3_client):
+    """
+    Replace the shared S3 client, e.g. with eval_kit.local_s3.LocalS3Client for tests.
+
+    params:
+    - s3_client: object implementing the boto3 S3 client methods used by this module
+    """
+    global _s3_client
+    with _s3_client_lock:
+        _s3_client = s3_client
+
+
+def _ordered_map(func, items, workers):
+    """
+    Apply func to every item on a pool of threads and yield the results in input order.
+    At most 2 * workers calls are in flight so a slow consumer does not pile up results.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+
+def open_storage(kind=None):
+    """
+    Return the storage backend (eval_kit.storage.Storage) get_image reads from,
+    serving the images of CELEBASPOOF_PACK_INDEX from their packs when it is set.
+
+    params:
+    - kind (str): 's3' or 'local', defaults to STORAGE
+    """
+    kind = kind or STORAGE
+    if kind == 's3':
+        storage = S3Storage(_get_s3_client(), WORKSPACE_BUCKET)
+    elif kind == 'local':
+        storage = LocalStorage(STORAGE_ROOT)
+    else:
+        raise ValueError("Unknown storage {}, expected 's3' or 'local'".format(kind))
+    if PACK_INDEX:
+        # images are sliced out of a few large packs, see tools/pack_images.py
+        storage = PackedStorage(storage, PACK_INDEX)
+    return storage
 
 
 def _get_s3_image_list(s3_bucket, s3_path):
-    s3_client = boto3.client('s3', region_name='us-west-2')
-    f = BytesIO()
-    # logging.info("s3_bucket and  s3_path {}{}".format(s3_bucket, s3_path))
-    s3_client.download_fileobj(s3_bucket, s3_path, f)
-    lines = f.getvalue().decode('utf-8').split('\n')
-    return [x.strip() for x in lines if x != '']
-
-
-def _download_s3_image(s3_bucket, s3_path, filename):
-    s3_client = boto3.client('s3', region_name='us-west-2')
-    image_name = filename.split('/')[-1]
-    local_path = os.path.join(TMP_PATH, image_name)
-    #download required image from s3 to local
-    s3_client.download_file(s3_bucket, s3_path, local_path)
-
-def _upload_output_to_s3(data, filename, s3_bucket, s3_prefix):
-    s3_client = boto3.client('s3', region_name='us-west-2')
-    local_path = os.path.join(TMP_PATH, filename)
-    s3_path = os.path.join(s3_prefix, filename)
-    
-    # Put data into binary file
-    data_str = json.dumps(data)
-    encode_data = data_str.encode()
-    with open(local_path, 'wb') as f:
-        f.write(encode_data)
-    s3_client.upload_file(local_path, s3_bucket, s3_path)
+    return S3Storage(_get_s3_client(), s3_bucket).read_lines(s3_path)
+
 
+def get_image_list(storage=None):
+    return (storage or open_storage()).read_lines(IMAGE_LIST_PATH)
 
 def get_job_name():
     return os.environ['CELEBASPOOF_EVAL_JOB_NAME']
 
 
+def open_eval_output(job_name, output_format=None, compress=None):
+    """
+    This function opens a streaming upload of the testing output to S3, which triggers evaluation once closed.
+    Outputs are added batch by batch with writer.add(image_ids, probs) and uploaded in parts while
+    the evaluation runs, call writer.close() when every image is done.
+
+    params:
+    - job_name (str)
+    - output_format (str): 'json' or 'compact', defaults to OUTPUT_FORMAT
+    - compress (bool): zlib compress the output, defaults to OUTPUT_COMPRESS
+    return:
+    - eval_kit.output.OutputWriter
+    """
+    filename = '{}.bin'.format(job_name)
+    sink = S3MultipartSink(_get_s3_client(), WORKSPACE_BUCKET, os.path.join(UPLOAD_PREFIX, filename))
+    return OutputWriter(sink, output_format or OUTPUT_FORMAT, OUTPUT_COMPRESS if compress is None else compress)
+
+
+def open_journal(job_name, fingerprint=None):
+    """
+    This function opens the journal of an evaluation job and loads the scores completed by previous runs.
+
+    params:
+    - fingerprint (str): identifies the model and every setting changing its scores, scores journaled
+      under another fingerprint are not reused (see CelebASpoofDetector.fingerprint and decode_config)
+    return:
+    - eval_kit.journal.EvalJournal, or None when journaling is disabled
+    """
+    if not JOURNAL_DIR:
+        return None
+    if JOURNAL_S3:
+        journal = EvalJournal(job_name, s3_client=_get_s3_client(), s3_bucket=WORKSPACE_BUCKET,
+                              s3_prefix=os.path.join(JOURNAL_PREFIX, job_name), fingerprint=fingerprint)
+    else:
+        journal = EvalJournal(job_name, fingerprint=fingerprint)
+    journal.load()
+    return journal
+
+
+def open_tensor_store(detector_class, image_list):
+    """
+    This function opens the preprocessed-tensor store of an image list for a detector (see eval_kit.tensor_store).
+
+    return:
+    - eval_kit.tensor_store.TensorStore, or None when the store is disabled or the detector has no preprocess_fingerprint
+    """
+    if not TENSOR_STORE_DIR:
+        return None
+    config = detector_class.preprocess_fingerprint()
+    if config is None:
+        logging.info("{} does not support a tensor store".format(detector_class.__name__))
+        return None
+    return TensorStore(image_list, '{} {}'.format(config, decode_config()))
+
+
+def iter_tensor_store(store, detector_class, image_iter, batch_policy, skip_ids=None):
+    """
+    Feed the detector from the tensor store of its image list once it exists, and otherwise
+    fill the store from image_iter while resizing its batches with the detector.
+
+    params:
+    - store (eval_kit.tensor_store.TensorStore): from open_tensor_store
+    - image_iter: function returning the image iterator, only called when the store does not exist yet
+    - batch_policy (eval_kit.batching.BatchPolicy)
+    - skip_ids (set): images that are not yielded, e.g. the ones already in the journal
+    return: tuple(image_id: numpy.array, images: numpy.array)
+    """
+    if store.exists:
+        return store.iter_batches(batch_policy, skip_ids)
+    return store.fill(image_iter(), detector_class.resize_images)
+
+
+def open_shard_board(job_name, shards, fingerprint=None, node_id=None):
+    """
+    This function opens the shard board of a sharded evaluation job in the workspace bucket.
+
+    params:
+    - shards (list): the image ids of every shard, see eval_kit.sharding.split_shards
+    - fingerprint (str): identifies the model and every setting changing its scores, shard outputs
+      of another fingerprint, image list or shard size are not reused (see open_journal)
+    - node_id (str): name of this node, defaults to SHARD_NODE
+    return:
+    - eval_kit.sharding.ShardBoard
+    """
+    return ShardBoard(_get_s3_client(), WORKSPACE_BUCKET, job_name, len(shards), node_id or SHARD_NODE,
+                      board_key(shards, fingerprint))
+
+
 def upload_eval_output(output_probs, job_name):
     """
     This function uploads the testing output to S3 to trigger evaluation.
     
     params:
     - output_probs (dict): dict of probability of every image
-    - output_times (dict): dict of processing time of every image
     - job_name (str)
 
     """
-    upload_data = {
-        i: {
-            "prob": output_probs[i],
-        } for i in output_probs
-    }
-
-    filename = '{}.bin'.format(job_name)
+    writer = open_eval_output(job_name)
+    image_ids = list(output_probs)
+    writer.add(image_ids, [output_probs[i] for i in image_ids])
+    writer.close()
 
-    _upload_output_to_s3(upload_data, filename, WORKSPACE_BUCKET, UPLOAD_PREFIX)
-
-    logging.info("output uploaded to {}{}".format(UPLOAD_PREFIX, filename))
+    logging.info("output uploaded to {}{}.bin".format(UPLOAD_PREFIX, job_name))
 
 def read_image(image_path):
     """
@@ -111,97 +268,158 @@ def read_image(image_path):
     # Your change ends here.
     ########################################################################################################
 
-def get_image():
+def decode_image(data, min_size=None):
+    """
+    Decode an encoded image (png, jpg, ...) held in memory
+
+    params:
+        - data (bytes): the encoded image.
+        - min_size (int): decode large png and jpg images at a reduced scale keeping both sides
+          at least min_size (see eval_kit.decode_pool.reduced_decode), defaults to REDUCED_DECODE
+    return:
+        - image: Required image in RGB color format.
+    """
+    min_size = REDUCED_DECODE if min_size is None else min_size
+    flag = cv2.IMREAD_COLOR
+    size = peek_image_size(data, allow_exif=True) if min_size else None
+    if size is not None:
+        flag, _ = reduced_decode(data, size, min_size)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise ValueError("Failed to decode image of {} bytes".format(len(data)))
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+def decode_config():
+    """
+    Settings of the image iterators that change the pixels given to the detector,
+    to be added to the fingerprint of a prediction cache.
+    """
+    return 'ingest_size={} reduced_decode={}'.format(INGEST_SIZE, REDUCED_DECODE)
+
+def _fetch_image(image_id, storage, image_prefix, cache=None, decode=True):
+    """
+    Read one image from storage into memory and decode it, return (image_id, image, elapsed).
+    image is None when the prediction cache already holds its score, and the encoded bytes when decode is False.
+    """
+    st = time.time()
+    image_path = os.path.join(image_prefix, image_id)
+    try:
+        with metrics.time('download'):
+            data = storage.read(image_path)
+    except:
+        logging.info("Failed to download image: {}".format(image_path))
+        raise
+    if cache is not None and cache.lookup(image_id, data) is not None:
+        return image_id, None, time.time() - st
+    if not decode:
+        return image_id, data, time.time() - st
+    with metrics.time('decode'):
+        image = decode_image(data)
+    return image_id, image, time.time() - st
+
+
+def iter_images(storage, image_list, image_prefix, workers=None, cache=None, skip_ids=None, batch_policy=None,
+                decode_workers=None, prefetch_depth=None):
+    """
+    Iterate over batches of the images of image_list read from storage at image_prefix.
+    Images are read concurrently by a pool of workers and written into reusable batch
+    buffers (see eval_kit.batching.BatchBuffer), batches are yielded in the order of the
+    image list. get_image and get_local_image only differ by their storage.
+
+    params:
+    - storage (eval_kit.storage.Storage): e.g. S3Storage, LocalStorage or MemoryStorage
+    - image_list (list): ids of the images
+    - image_prefix (str): key prefix of the images in storage
+    - workers (int): number of concurrent reads, defaults to FETCH_WORKERS
+    - cache (eval_kit.cache.PredictionCache): images with a cached score are not decoded or yielded
+    - skip_ids (set): images that are not read at all, e.g. the ones already in the journal
+    - batch_policy (eval_kit.batching.BatchPolicy): sizes the batches from a memory budget,
+      defaults to BATCH_SIZE images within CELEBASPOOF_MEMORY_BUDGET
+    - decode_workers (int): processes decoding into shared-memory batches (see eval_kit.decode_pool),
+      defaults to CELEBASPOOF_DECODE_WORKERS, 0 decodes in process
+    - prefetch_depth (int): depth of the eval_kit.prefetch.PrefetchIterator the iterator is handed to.
+      Its batches are then yielded straight from the batch buffers, which are sized so that no batch
+      is overwritten while it is queued or scored. By default every batch is a copy the caller can keep.
+
+    return: tuple(image_id: numpy.array, images: numpy.array)
+    images is of shape (N, H, W, 3), or a list of (H, W, 3) arrays when their shapes differ
+    """
+    workers = workers or FETCH_WORKERS
+    if skip_ids:
+        image_list = [x for x in image_list if x not in skip_ids]
+        logging.info("skipping already scored images, {} image left".format(len(image_list)))
+    batch_policy = batch_policy or BatchPolicy(BATCH_SIZE)
+    logging.info("Batch_size=, {}".format(batch_policy))
+    logging.info("Fetch workers=, {}".format(workers))
+    slots = buffer_slots(prefetch_depth)
+    decoder = open_decode_pool(batch_policy, decode_image, decode_workers, slots)
+    buffer = decoder or BatchBuffer(batch_policy, slots=slots)
+
+    def ready_batches(batches):
+        if prefetch_depth is None:
+            return [(image_ids, copy_batch(images)) for image_ids, images in batches]
+        return batches
+
+    try:
+        fetch = partial(_fetch_image, storage=storage, image_prefix=image_prefix, cache=cache,
+                        decode=decoder is None)
+        for image_id, image, elapsed in _ordered_map(fetch, image_list, workers):
+            logging.debug("image downloading & image reading time: {}".format(elapsed))
+            if image is None:
+                continue
+            with metrics.time('batch_assembly'):
+                ready = ready_batches(buffer.add(image_id, image))
+            for batch in ready:
+                yield batch
+
+        for batch in ready_batches(buffer.flush()):
+            yield batch
+    finally:
+        if decoder is not None:
+            decoder.close()
+
+
+def get_image(workers=None, cache=None, skip_ids=None, batch_policy=None, decode_workers=None, image_list=None,
+              storage=None, prefetch_depth=None):
     """
     This function returns a iterator of test images.
     Each iteration provides a tuple of (video_id, image), image will be in RGB color format with array shape of (height, width, 3).
-    
+    Images are read from the workspace bucket, or the storage selected by CELEBASPOOF_STORAGE,
+    see iter_images for the other params.
+
+    params:
+    - image_list (list): ids of the images to fetch, defaults to the image list of the storage
+    - storage (eval_kit.storage.Storage): defaults to open_storage()
+
     return: tuple(video_id: str, frames: numpy.array)
     """
-    image_list = _get_s3_image_list(WORKSPACE_BUCKET, IMAGE_LIST_PATH)
+    storage = storage or open_storage()
+    if image_list is None:
+        image_list = get_image_list(storage)
     logging.info("got image list, {} image".format(len(image_list)))
-    logging.info("Batch_size=, {}".format(BATCH_SIZE))
-    n = 0
-    final_image = []
-    final_image_buff = []
-    final_image_id = []
-    final_image_id_buff = []
-
-    for idx,image_id in enumerate(image_list):
-        # get video from s3
-        st = time.time()
-        try:
-            #download required image from s3 to local
-            _download_s3_image(WORKSPACE_BUCKET, os.path.join(IMAGE_PREFIX, image_id), image_id)
-        except:
-            logging.info("Failed to download image: {}".format(os.path.join(IMAGE_PREFIX, image_id)))
-            raise
-        image_name = image_id.split('/')[-1]
-        image_local_path = os.path.join(TMP_PATH, image_name) # local path of the video named video_id
-        image = read_image(image_local_path)
-        final_image_buff.append(image)
-        final_image_id_buff.append(image_id)
-        if len(final_image_buff) == 500:
-            final_image.extend(final_image_buff)
-            final_image_buff = []
-            final_image_id.extend(final_image_id_buff)
-            final_image_id_buff = []
-
-        n += 1
-        elapsed = time.time() - st
-        logging.info("image downloading & image reading time: {}".format(elapsed))
-
-        if n == BATCH_SIZE or idx == len(image_list) - 1:
-            final_image.extend(final_image_buff)
-            final_image_id.extend(final_image_id_buff)
-            np_final_image_id = np.array(final_image_id)
-            np_final_image = np.array(final_image)
-            n = 0
-            yield np_final_image_id, np_final_image
-
-            try:
-                for i in final_image_id:
-                    os.remove(i) # remove the local image 
-            except:
-                logging.info("Failed to delete this image, error: {}".format(sys.exc_info()[0]))
-
-            final_image = []
-            final_image_buff = []
-            final_image_id = []
-            final_image_id_buff = []
-
-def get_local_image(max_number=None):
+    return iter_images(storage, image_list, IMAGE_PREFIX, workers, cache, skip_ids, batch_policy, decode_workers,
+                       prefetch_depth)
+
+def get_local_image(max_number=None, cache=None, skip_ids=None, batch_policy=None, decode_workers=None,
+                    storage=None, prefetch_depth=None):
     """
     This function returns a iterator of image.
     It is used for local test of participating algorithms.
     Each iteration provides a tuple of (image_id, image), each image will be in RGB color format with array shape of (height, width, 3)
+    Images are read from the local files, see iter_images for the other params.
+
+    params:
+    - max_number (int): only read the first max_number images of the list
+    - storage (eval_kit.storage.Storage): defaults to the current directory
     
     return: tuple(image_id: str, image: numpy.array)
     """
-    image_list = [x.strip() for x in open(LOCAL_IMAGE_LIST_PATH)]
+    storage = storage or LocalStorage()
+    image_list = storage.read_lines(LOCAL_IMAGE_LIST_PATH)[:max_number]
     logging.info("got local image list, {} image".format(len(image_list)))
-    logging.info("Batch_size=, {}".format(BATCH_SIZE))
-    n = 0
-    final_image = []
-    final_image_id = []
-    for idx,image_id in enumerate(image_list):
-        # get image from local file
-        try:
-            image = read_image(os.path.join(LOCAL_IMAGE_PREFIX, image_id))
-            final_image.append(image)
-            final_image_id.append(image_id)
-            n += 1
-        except:
-            logging.info("Failed to read image: {}".format(os.path.join(LOCAL_IMAGE_PREFIX, image_id)))
-            raise
-
-        if n == BATCH_SIZE or idx == len(image_list) - 1:
-            np_final_image_id = np.array(final_image_id)
-            np_final_image = np.array(final_image)
-            n = 0
-            final_image = []
-            final_image_id = []
-            yield np_final_image_id, np_final_image
+    return iter_images(storage, image_list, LOCAL_IMAGE_PREFIX, cache=cache, skip_ids=skip_ids,
+                       batch_policy=batch_policy, decode_workers=decode_workers, prefetch_depth=prefetch_depth)
 
 
 
@@ -0,0 +1,264 @@
+import logging
+import multiprocessing
+import os
+import struct
+import time
+import weakref
+
+import cv2
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from eval_kit.batching import BatchBuffer, INGEST_SIZE, buffer_slots
+from eval_kit.metrics import metrics
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+# Number of processes decoding images into shared-memory batches, 0 decodes in the calling process.
+# It needs CELEBASPOOF_MEMORY_BUDGET, which bounds every shared memory segment: /dev/shm must hold
+# buffer_slots(prefetch depth) of them, e.g. docker run --shm-size for the default of 64MB.
+DECODE_WORKERS = int(os.environ.get('CELEBASPOOF_DECODE_WORKERS', 0))
+# Decode images at 1/2, 1/4 or 1/8 scale when both sides stay at least this many pixels,
+# e.g. CELEBASPOOF_REDUCED_DECODE=224 for the 224x224 AENet input. 0 decodes at full size.
+REDUCED_DECODE = int(os.environ.get('CELEBASPOOF_REDUCED_DECODE', 0))
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start of frame markers, the ones carrying the image size
+_JPEG_SOF = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def peek_image_size(data, allow_exif=False):
+    """
+    Read the size of an encoded PNG or JPEG image from its header, without decoding it.
+
+    params:
+    - data (bytes): the encoded image
+    - allow_exif (bool): also read JPEGs with Exif data, whose orientation tag may make
+      the decoded image transposed
+    return:
+    - (height, width), or None for other formats and, unless allow_exif, JPEGs with Exif data
+    """
+    if data[:8] == _PNG_SIGNATURE and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return height, width
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xff:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xff:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            pos += 2
+            continue
+        length, = struct.unpack('>H', data[pos + 2:pos + 4])
+        if marker == 0xe1 and data[pos + 4:pos + 10] == b'Exif\x00\x00' and not allow_exif:
+            return None
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return height, width
+        pos += 2 + length
+    return None
+
+
+def reduced_decode(data, size, min_size=REDUCED_DECODE):
+    """
+    Pick the smallest decode scale keeping both sides of the image at least min_size.
+    libjpeg decodes JPEGs straight at that scale, other formats are decoded then shrunk by OpenCV.
+
+    params:
+    - data (bytes): the encoded image
+    - size (tuple): (height, width) from peek_image_size
+    - min_size (int): 0 keeps the full size
+    return:
+    - cv2.imdecode flag
+    - (height, width) of the decoded image
+    """
+    height, width = size
+    if min_size:
+        for factor, flag in _REDUCED_FLAGS:
+            if min(height, width) // factor >= min_size:
+                if data[:2] == b'\xff\xd8':
+                    # libjpeg rounds the scaled size up
+                    return flag, (-(-height // factor), -(-width // factor))
+                return flag, (height // factor, width // factor)
+    return cv2.IMREAD_COLOR, size
+
+
+# segment the worker wrote to last, consecutive images mostly share a batch
+_attached = [None]
+
+
+def _attach(name):
+    shm = _attached[0]
+    if shm is None or shm.name != name:
+        if shm is not None:
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[0] = shm
+    return shm
+
+
+def _init_worker():
+    # parallelism comes from the pool, keep every worker on one core
+    cv2.setNumThreads(1)
+
+
+def _decode_into(data, flag, name, offset, shape, ingest_size):
+    """
+    Decode an image in a worker process and write it as RGB into its batch slot in shared memory.
+    Same pixels as decode_image followed by BatchBuffer.add.
+
+    return:
+    - decode time in seconds
+    """
+    st = time.time()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise ValueError("Failed to decode image of {} bytes".format(len(data)))
+    if ingest_size is not None and img.shape != shape:
+        # resizing before the color conversion gives the same pixels, both work per channel
+        img = cv2.resize(img, ingest_size, interpolation=cv2.INTER_AREA)
+    if img.shape != shape:
+        raise ValueError("Decoded image of shape {}, expected {}".format(img.shape, shape))
+    view = np.ndarray(shape, dtype=np.uint8, buffer=_attach(name).buf, offset=offset)
+    converted = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=view)
+    if converted is not view:
+        view[...] = converted
+    del view
+    return time.time() - st
+
+
+def _release(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class DecodePool(object):
+    """
+    Decode images on a pool of worker processes, straight into batches held in shared memory.
+
+    The batch slot of an image is reserved from its header size (see peek_image_size), the
+    encoded bytes are sent to a worker which writes the RGB pixels into the slot, and the
+    batch is returned once all of its images are written. Batches are plain numpy arrays over
+    the shared memory, no pixel data is pickled or copied between processes.
+    Images whose size cannot be read from the header are decoded in the calling process by
+    fallback_decode(data). With min_size set, large images are decoded at a reduced scale
+    (see reduced_decode).
+
+    Shared memory segments are unlinked once their batch arrays are garbage collected. The
+    batch policy must have a memory budget, which caps each of the slots segments: without
+    one a segment would hold batch_size full-size images, far more than a container's /dev/shm.
+    """
+
+    def __init__(self, batch_size, fallback_decode, workers=DECODE_WORKERS, ingest_size=INGEST_SIZE,
+                 min_size=REDUCED_DECODE, slots=buffer_slots()):
+        methods = multiprocessing.get_all_start_methods()
+        # forking from the threads of the evaluation pipeline is unsafe, start workers from a clean process
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.workers = workers
+        self.fallback_decode = fallback_decode
+        self.ingest_size = ingest_size
+        self.min_size = min_size
+        self.buffer = BatchBuffer(batch_size, ingest_size=ingest_size, slots=slots, allocator=self.allocate)
+        budget = self.buffer.policy.memory_budget
+        if not budget:
+            raise ValueError("Decoding on worker processes needs a memory budget to size its shared memory, "
+                             "set CELEBASPOOF_MEMORY_BUDGET")
+        logging.info("Decode pool: up to {} shared memory segments of at most {} bytes".format(slots, budget))
+        self._executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker)
+        self._segments = weakref.WeakValueDictionary()
+        self._pending = {}
+        self.fallback_count = 0
+
+    def allocate(self, shape):
+        """
+        BatchBuffer allocator returning a uint8 array in a new shared memory segment.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+        array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        self._segments[shm.name] = array
+        weakref.finalize(array, _release, shm)
+        return array
+
+    def _locate(self, view):
+        address = view.ctypes.data
+        for name, array in self._segments.items():
+            start = array.ctypes.data
+            if start <= address < start + array.nbytes:
+                return name, address - start
+        raise ValueError("View is not in a shared memory batch")
+
+    def _wait(self, ready):
+        for image_ids, _ in ready:
+            for image_id in image_ids:
+                future = self._pending.pop(image_id, None)
+                if future is not None:
+                    metrics.record('decode', future.result())
+        return ready
+
+    def add(self, image_id, data):
+        """
+        Queue an encoded image for decoding.
+
+        params:
+        - image_id (str)
+        - data (bytes): the encoded image
+        return:
+        - list of (image_id: numpy.array, images: numpy.array) batches that are ready
+        """
+        size = peek_image_size(data)
+        if size is None:
+            self.fallback_count += 1
+            with metrics.time('decode'):
+                image = self.fallback_decode(data)
+            return self._wait(self.buffer.add(image_id, image))
+        flag, size = reduced_decode(data, size, self.min_size)
+        shape = self.buffer.batch_shape(*size)
+        view, ready = self.buffer.reserve(image_id, shape)
+        name, offset = self._locate(view)
+        # an image listed twice, its first copy must be written before the id is reused
+        self._wait([([image_id], None)])
+        # slices of an image pack are memoryviews, which cannot be pickled
+        self._pending[image_id] = self._executor.submit(_decode_into, bytes(data), flag, name, offset, shape,
+                                                        self.ingest_size)
+        return self._wait(ready)
+
+    def flush(self):
+        """
+        Return the remaining partial batches once they are decoded.
+        """
+        return self._wait(self.buffer.flush())
+
+    def close(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._executor.shutdown()
+        logging.info("Decode pool: {} workers, {} images decoded in process".format(self.workers, self.fallback_count))
+
+
+def open_decode_pool(batch_size, fallback_decode, workers=None, slots=buffer_slots()):
+    """
+    Return a DecodePool of workers processes, defaults to DECODE_WORKERS,
+    or None when decoding stays in process. slots is passed on to its BatchBuffer.
+    """
+    workers = DECODE_WORKERS if workers is None else workers
+    if not workers:
+        return None
+    if shared_memory is None:
+        logging.info("multiprocessing.shared_memory is not available, decoding in process")
+        return None
+    return DecodePool(batch_size, fallback_decode, workers, slots=slots)
@@ -9,6 +9,36 @@ class CelebASpoofDetector(ABC):
         not be counted in runtime evaluation
         """
 
+    @classmethod
+    def fingerprint(cls):
+        """
+        Optionally return a string identifying the model and every setting that changes its scores.
+        When it is defined, predictions can be cached across evaluation runs (see eval_kit.cache).
+        """
+        return None
+
+    @classmethod
+    def preprocess_fingerprint(cls):
+        """
+        Optionally return a string identifying every setting of resize_images.
+        When it is defined, resized images can be stored across evaluation runs (see eval_kit.tensor_store)
+        and given back to predict, which must score them the same as the original images.
+        """
+        return None
+
+    @classmethod
+    def resize_images(cls, images):
+        """
+        Resize a batch of images to the uint8 input size of the model, only called when
+        preprocess_fingerprint is defined.
+
+        params:
+            - images: uint8 array of shape (N, H, W, 3), or a list of (H, W, 3) arrays
+        return:
+            - uint8 array of shape (N, h, w, 3)
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def predict(self, image):
         """
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+
+from io import BytesIO
+
+
+# Directory of the evaluation journals, set it to an empty string to disable journaling.
+JOURNAL_DIR = os.environ.get('CELEBASPOOF_JOURNAL_DIR', '/tmp/celebaspoof_journal')
+
+
+class EvalJournal(object):
+    """
+    Append-only record of the scores of an evaluation job, written at batch boundaries,
+    so a job restarted with the same CELEBASPOOF_EVAL_JOB_NAME only scores the remaining images.
+
+    Every batch is one json line {"ids": [...], "probs": [...]} flushed and fsynced to
+    <journal_dir>/<job_name>.jsonl, after a first {"fingerprint": ...} line naming the model
+    that wrote it. A journal of another model is discarded when loading, and a line torn by a
+    crash is ignored. With an s3_client every batch is also uploaded as its own object
+    <s3_prefix><model>/<n>.jsonl, and the journal is restored from there when the local file
+    is missing or behind (e.g. on a new container). clear() removes the journal once the job is done.
+    """
+
+    def __init__(self, job_name, journal_dir=JOURNAL_DIR, s3_client=None, s3_bucket=None, s3_prefix=None,
+                 fingerprint=None):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.path = os.path.join(journal_dir, '{}.jsonl'.format(job_name))
+        self.fingerprint = fingerprint
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        if s3_client is not None:
+            model = hashlib.sha256((fingerprint or '').encode('utf-8')).hexdigest()[:16]
+            self.s3_prefix = os.path.join(s3_prefix, model)
+        self.completed = {}
+        self._file = None
+        self._objects = 0
+
+    def _object_key(self, number):
+        return os.path.join(self.s3_prefix, '{:08d}.jsonl'.format(number))
+
+    def _count_objects(self):
+        number = 0
+        while True:
+            try:
+                self.s3_client.head_object(Bucket=self.s3_bucket, Key=self._object_key(number))
+            except Exception:
+                return number
+            number += 1
+
+    def _download(self, count):
+        lines = []
+        for number in range(count):
+            f = BytesIO()
+            self.s3_client.download_fileobj(self.s3_bucket, self._object_key(number), f)
+            lines.append(f.getvalue())
+        return lines
+
+    def _header(self):
+        return json.dumps({'fingerprint': self.fingerprint}).encode('utf-8') + b'\n'
+
+    def _read_local(self):
+        """
+        return:
+        - the complete lines of the local journal, header first, or [] when there is none for this model
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data and not data.startswith(self._header()):
+            logging.info("Journal {} was written by another model, starting over".format(self.path))
+            return []
+        lines = []
+        for line in data.split(b'\n'):
+            try:
+                json.loads(line.decode('utf-8'))
+            except ValueError:
+                # a line torn by a crash, and everything after it
+                break
+            lines.append(line + b'\n')
+        return lines
+
+    def load(self):
+        """
+        Read the scores journaled by previous runs of the job with the same model.
+
+        return:
+        - dict of image_id -> spoof probability, also kept in self.completed
+        """
+        lines = self._read_local()
+        if self.s3_client is not None:
+            stored = self._count_objects()
+            if stored > len(lines):
+                lines = self._download(stored)
+            # batches journaled locally but not uploaded before a crash
+            for number in range(stored, len(lines)):
+                self.s3_client.put_object(Bucket=self.s3_bucket, Key=self._object_key(number), Body=lines[number])
+            self._objects = len(lines)
+        if lines:
+            with open(self.path, 'wb') as f:
+                f.write(b''.join(lines))
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        for line in lines[1:]:
+            entry = json.loads(line.decode('utf-8'))
+            self.completed.update(zip(entry['ids'], entry['probs']))
+        logging.info("Journal {}: {} images already scored".format(self.path, len(self.completed)))
+        return self.completed
+
+    def _write(self, line):
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self.s3_client is not None:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=self._object_key(self._objects), Body=line)
+            self._objects += 1
+
+    def append(self, image_ids, probs):
+        """
+        Durably record the spoof probabilities of a finished batch.
+        """
+        if len(image_ids) == 0:
+            return
+        if self._file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, 'ab')
+            if new:
+                self._write(self._header())
+        line = json.dumps({'ids': [str(i) for i in image_ids], 'probs': [float(p) for p in probs]})
+        self._write(line.encode('utf-8') + b'\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        """
+        Remove the journal once the output of the job is uploaded, a later job of the same name starts afresh.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.s3_client is not None:
+            for number in range(self._objects):
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=self._object_key(number))
+            self._objects = 0
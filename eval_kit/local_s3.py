@@ -0,0 +1,87 @@
+import os
+import shutil
+import threading
+import uuid
+
+
+class LocalS3Client(object):
+    """
+    A filesystem-backed stand-in for the boto3 S3 client.
+    Object `key` of `bucket` is stored at `<root>/<bucket>/<key>`, so a test data directory
+    can be served to eval_kit.client without network access:
+
+        from eval_kit import client
+        from eval_kit.local_s3 import LocalS3Client
+        client.set_s3_client(LocalS3Client('/data/s3'))
+
+    Only the methods used by the evaluation toolkit are implemented.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        with self._lock:
+            self.request_count += 1
+        return os.path.join(self.root, bucket, key)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        with open(self._path(Bucket, Key), 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(Fileobj, f)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return {'ContentLength': os.path.getsize(self._path(Bucket, Key))}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if os.path.exists(path):
+            os.remove(path)
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._path('.multipart', upload_id))
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with open(os.path.join(self._path('.multipart', UploadId), '{:05d}'.format(PartNumber)), 'wb') as f:
+            f.write(Body)
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        upload_dir = self._path('.multipart', UploadId)
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in sorted(MultipartUpload['Parts'], key=lambda p: p['PartNumber']):
+                with open(os.path.join(upload_dir, '{:05d}'.format(part['PartNumber'])), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+        shutil.rmtree(upload_dir)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        shutil.rmtree(self._path('.multipart', UploadId), ignore_errors=True)
+        return {}
@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Write the per-stage report of the job as json to this path.
+METRICS_PATH = os.environ.get('CELEBASPOOF_METRICS_PATH')
+
+
+class Metrics(object):
+    """
+    Thread-safe latency and throughput recorder for the stages of the evaluation pipeline
+    (download, decode, batch_assembly, preprocess, forward, postprocess, upload, ...).
+
+        with metrics.time('decode'):
+            image = decode_image(data)
+
+    Stages running on worker threads overlap, so their total seconds can exceed the wall time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = OrderedDict()
+        self._local = threading.local()
+        self.start_time = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._samples = OrderedDict()
+            self.start_time = time.time()
+
+    def record(self, stage, seconds, items=1):
+        """
+        params:
+        - stage (str)
+        - seconds (float): duration of one call of the stage
+        - items (int): number of images the call processed
+        """
+        if getattr(self._local, 'muted', False):
+            return
+        with self._lock:
+            self._samples.setdefault(stage, []).append((seconds, items))
+
+    @contextmanager
+    def time(self, stage, items=1):
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - st, items)
+
+    @contextmanager
+    def muted(self):
+        """
+        Drop the samples recorded by the calling thread, e.g. the probe runs of the batch size autotune.
+        """
+        self._local.muted = True
+        try:
+            yield
+        finally:
+            self._local.muted = False
+
+    def report(self):
+        """
+        return:
+        - dict with the wall time and, per stage, the call count, image count, total seconds,
+          p50/p95/p99 call latency in milliseconds and images per second of stage time
+        """
+        with self._lock:
+            samples = [(stage, list(values)) for stage, values in self._samples.items()]
+        stages = OrderedDict()
+        for stage, values in samples:
+            seconds = np.array([v[0] for v in values])
+            items = int(sum(v[1] for v in values))
+            total = float(seconds.sum())
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) * 1000
+            stages[stage] = {
+                'count': len(values),
+                'images': items,
+                'total_s': total,
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+                'images_per_s': items / total if total > 0 else 0.0,
+            }
+        return {'wall_s': time.time() - self.start_time, 'stages': stages}
+
+    def log_report(self, path=METRICS_PATH):
+        """
+        Log the report and write it as json to path, if any.
+        """
+        report = self.report()
+        for stage, stats in report['stages'].items():
+            logging.info("{:>15}: {count} calls, {images} images, {total_s:.3f}s, p50 {p50_ms:.2f}ms, "
+                         "p95 {p95_ms:.2f}ms, p99 {p99_ms:.2f}ms, {images_per_s:.1f} images/s".format(stage, **stats))
+        logging.info("Metrics report: {}".format(json.dumps(report)))
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+# Recorder shared by the evaluation toolkit and the detector.
+metrics = Metrics()
@@ -0,0 +1,178 @@
+import json
+import logging
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from eval_kit.metrics import metrics
+
+
+# S3 needs every part but the last of a multipart upload to be at least 5MB.
+PART_SIZE = 8 * 1024 * 1024
+
+# Compact format: COMPACT_MAGIC, then one block per batch made of a little-endian uint32
+# image count, a uint32 byte length of the '\n'-joined utf-8 image ids, the ids, and the
+# spoof probabilities as little-endian float32.
+COMPACT_MAGIC = b'CSPF0001'
+FORMATS = ('json', 'compact')
+
+
+class S3MultipartSink(object):
+    """
+    File-like sink uploading what is written to it to S3 in parts of PART_SIZE bytes.
+    Parts are uploaded on a background thread while more data is produced. Outputs that
+    never fill a part are sent with a single put_object.
+    """
+
+    def __init__(self, s3_client, s3_bucket, s3_path, part_size=PART_SIZE):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_path = s3_path
+        self.part_size = part_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _upload_part(self, number, data):
+        with metrics.time('upload', items=0):
+            response = self.s3_client.upload_part(Bucket=self.s3_bucket, Key=self.s3_path, UploadId=self._upload_id,
+                                                  PartNumber=number, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    def _flush_part(self):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_path)
+            self._upload_id = response['UploadId']
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._parts.append(self._executor.submit(self._upload_part, len(self._parts) + 1, data))
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._flush_part()
+
+    def close(self):
+        st = time.time()
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_path, Body=bytes(self._buffer))
+                return
+            if self._buffer:
+                self._flush_part()
+            parts = [part.result() for part in self._parts]
+            self.s3_client.complete_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_path, UploadId=self._upload_id,
+                                                     MultipartUpload={'Parts': parts})
+        except:
+            if self._upload_id is not None:
+                self.s3_client.abort_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_path,
+                                                      UploadId=self._upload_id)
+            raise
+        finally:
+            self._executor.shutdown()
+            metrics.record('upload_tail', time.time() - st, items=0)
+
+    def abort(self):
+        """
+        Give up the upload, e.g. when the job fails, so no incomplete multipart upload is left behind.
+        """
+        for part in self._parts:
+            part.cancel()
+        self._executor.shutdown()
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_path, UploadId=self._upload_id)
+            self._upload_id = None
+
+
+class OutputWriter(object):
+    """
+    Serialise evaluation outputs incrementally as batches finish.
+
+    - 'json' writes the {image_id: {"prob": p}} document expected by the evaluation server,
+      byte for byte what json.dumps produces, without building it in memory.
+    - 'compact' writes image ids plus a float32 score array per batch (see COMPACT_MAGIC).
+
+    With compress=True the stream is zlib compressed.
+    """
+
+    def __init__(self, sink, output_format='json', compress=False):
+        if output_format not in FORMATS:
+            raise ValueError("Unknown output format {}, expected one of {}".format(output_format, FORMATS))
+        self.sink = sink
+        self.output_format = output_format
+        self.count = 0
+        self._compressor = zlib.compressobj() if compress else None
+        self._write(b'{' if output_format == 'json' else COMPACT_MAGIC)
+
+    def _write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self.sink.write(data)
+
+    def add(self, image_ids, probs):
+        """
+        params:
+        - image_ids (list of str)
+        - probs (list of float): spoof probability of every image
+        """
+        if len(image_ids) == 0:
+            return
+        st = time.time()
+        if self.output_format == 'json':
+            entries = ', '.join('{}: {{"prob": {}}}'.format(json.dumps(i), json.dumps(float(p)))
+                                for i, p in zip(image_ids, probs))
+            self._write(((', ' if self.count else '') + entries).encode('utf-8'))
+        else:
+            ids = '\n'.join(image_ids).encode('utf-8')
+            scores = np.asarray(probs, dtype='<f4').tobytes()
+            self._write(struct.pack('<II', len(image_ids), len(ids)) + ids + scores)
+        self.count += len(image_ids)
+        metrics.record('serialize', time.time() - st, len(image_ids))
+
+    def close(self):
+        if self.output_format == 'json':
+            self._write(b'}')
+        if self._compressor is not None:
+            self.sink.write(self._compressor.flush())
+        self.sink.close()
+        logging.info("Wrote {} outputs in {} format".format(self.count, self.output_format))
+
+    def abort(self):
+        """
+        Discard the output instead of closing it, when the sink supports it.
+        """
+        if hasattr(self.sink, 'abort'):
+            self.sink.abort()
+
+
+def read_output(data):
+    """
+    Parse an output written by OutputWriter in any format, compressed or not.
+
+    return:
+    - dict of image_id -> spoof probability
+    """
+    if data[:1] not in (b'{', COMPACT_MAGIC[:1]):
+        data = zlib.decompress(data)
+    if data[:1] == b'{':
+        return {i: v['prob'] for i, v in json.loads(data.decode('utf-8')).items()}
+
+    probs = {}
+    offset = len(COMPACT_MAGIC)
+    while offset < len(data):
+        count, ids_size = struct.unpack_from('<II', data, offset)
+        offset += 8
+        ids = data[offset:offset + ids_size].decode('utf-8').split('\n')
+        offset += ids_size
+        scores = np.frombuffer(data, dtype='<f4', count=count, offset=offset)
+        offset += 4 * count
+        probs.update(zip(ids, scores.tolist()))
+    return probs
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import threading
+
+from eval_kit.storage import Storage
+
+
+# Key of a pack index in the image storage, e.g. packs/challenge.index.json written by
+# tools/pack_images.py. Images listed in it are sliced out of the packs instead of read one by one.
+PACK_INDEX = os.environ.get('CELEBASPOOF_PACK_INDEX')
+# Target size of a pack in bytes.
+PACK_SIZE = int(os.environ.get('CELEBASPOOF_PACK_SIZE', 256 * 1024 * 1024))
+INDEX_VERSION = 1
+
+
+def write_packs(items, output_dir, name, pack_size=PACK_SIZE):
+    """
+    Bundle many small objects into a few large pack files plus an index.
+
+    Pack <name>-<n>.pack is the plain concatenation of the objects, and <name>.index.json
+    records the pack, offset and length of every object:
+
+        {"version": 1, "packs": ["<name>-00000.pack", ...],
+         "keys": ["test_data/494405.png", ...], "entries": [[pack, offset, length], ...]}
+
+    params:
+    - items: iterable of (key, bytes), in the order the objects will be read
+    - output_dir (str)
+    - name (str)
+    - pack_size (int): a new pack is started once the current one reaches this size
+    return:
+    - path of the index
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    packs, keys, entries = [], [], []
+    f = None
+    offset = 0
+    for key, data in items:
+        if f is None or offset >= pack_size:
+            if f is not None:
+                f.close()
+            packs.append('{}-{:05d}.pack'.format(name, len(packs)))
+            f = open(os.path.join(output_dir, packs[-1]), 'wb')
+            offset = 0
+        f.write(data)
+        keys.append(key)
+        entries.append([len(packs) - 1, offset, len(data)])
+        offset += len(data)
+    if f is not None:
+        f.close()
+
+    index_path = os.path.join(output_dir, '{}.index.json'.format(name))
+    with open(index_path, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'packs': packs, 'keys': keys, 'entries': entries}, f)
+    logging.info("Packed {} objects into {} packs, index {}".format(len(keys), len(packs), index_path))
+    return index_path
+
+
+class PackedStorage(Storage):
+    """
+    Storage serving the objects of a pack index (see write_packs) as zero-copy slices of their
+    packs, and any other key, e.g. the image list, from the underlying storage.
+
+    Every pack is fetched once as a whole through storage.map: memory-mapped from local files,
+    or downloaded with concurrent range requests from S3 and then memory-mapped. The next pack
+    is fetched in the background while the current one is read, and packs older than the
+    previous one are dropped: their mapping, and the temp file of a pack downloaded from S3,
+    go away once the slices read from them are released. A dropped pack is fetched again if
+    one of its objects is read later, so images should be read in the order they were packed.
+    """
+
+    def __init__(self, storage, index_key):
+        self.storage = storage
+        index = json.loads(bytes(storage.read(index_key)).decode('utf-8'))
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError("Unsupported pack index version {}".format(index.get('version')))
+        root = os.path.dirname(index_key)
+        self.packs = [os.path.join(root, pack) for pack in index['packs']]
+        self.index = dict(zip(index['keys'], index['entries']))
+        self._buffers = [None] * len(self.packs)
+        self._locks = [threading.Lock() for _ in self.packs]
+        logging.info("Pack index {}: {} objects in {} packs".format(index_key, len(self.index), len(self.packs)))
+
+    def _load(self, number):
+        with self._locks[number]:
+            if self._buffers[number] is None:
+                self._buffers[number] = memoryview(self.storage.map(self.packs[number]))
+        return self._buffers[number]
+
+    def _release(self, number):
+        with self._locks[number]:
+            if self._buffers[number] is not None:
+                self._buffers[number] = None
+                logging.debug("Released pack {}".format(self.packs[number]))
+
+    def _pack(self, number):
+        buffer = self._buffers[number]
+        if buffer is None:
+            buffer = self._load(number)
+            # reads moved on to this pack, the previous one is kept for the reads still lagging behind
+            for old in range(number - 1):
+                if self._buffers[old] is not None:
+                    self._release(old)
+            if number + 1 < len(self.packs):
+                threading.Thread(target=self._load, args=(number + 1,), daemon=True).start()
+        return buffer
+
+    def read(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return self.storage.read(key)
+        number, offset, length = entry
+        return self._pack(number)[offset:offset + length]
+
+    def map(self, key):
+        if key in self.index:
+            return self.read(key)
+        return self.storage.map(key)
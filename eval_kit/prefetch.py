@@ -0,0 +1,121 @@
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+
+# Number of batches fetched and decoded ahead of the batch being scored.
+PREFETCH_DEPTH = int(os.environ.get('CELEBASPOOF_PREFETCH_DEPTH', 2))
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class PrefetchIterator(object):
+    """
+    Run an image iterator (e.g. eval_kit.client.get_image()) on a background thread and
+    hand its batches over through a bounded queue, so batch N+1 is downloaded and decoded
+    while batch N is being scored. With start=False the thread only starts on start() or the
+    first batch, e.g. so that it does not compete with a batch size autotune for the CPU.
+
+    Counters:
+    - producer_stalls: times the producer found the queue full (inference is the bottleneck)
+    - consumer_stalls: times the consumer found the queue empty (I/O is the bottleneck)
+    - consumer_wait: seconds the consumer spent waiting for a batch
+    - max_depth / mean_depth: queue depth observed by the consumer
+    """
+
+    def __init__(self, iterator, depth=PREFETCH_DEPTH, start=True):
+        self.depth = max(1, depth)
+        self.batches = 0
+        self.producer_stalls = 0
+        self.consumer_stalls = 0
+        self.consumer_wait = 0.0
+        self.max_depth = 0
+        self._depth_sum = 0
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, args=(iterator,), name='prefetch')
+        self._thread.daemon = True
+        if start:
+            self.start()
+
+    def start(self):
+        if self._thread.ident is None:
+            self._thread.start()
+
+    def _put(self, item):
+        if self._queue.full():
+            self.producer_stalls += 1
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+        except:
+            self._put(_Failure(sys.exc_info()))
+            return
+        self._put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        self.start()
+        depth = self._queue.qsize()
+        self._depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        if depth == 0:
+            self.consumer_stalls += 1
+        st = time.time()
+        item = self._queue.get()
+        self.consumer_wait += time.time() - st
+        if item is _END:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._done = True
+            raise item.exc_info[1].with_traceback(item.exc_info[2])
+        self.batches += 1
+        return item
+
+    def close(self):
+        """
+        Stop the producer thread, e.g. when the consumer gives up early.
+        """
+        self._stop.set()
+        self._done = True
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'mean_depth': self._depth_sum / float(max(self.batches, 1)),
+            'producer_stalls': self.producer_stalls,
+            'consumer_stalls': self.consumer_stalls,
+            'consumer_wait': self.consumer_wait,
+        }
+
+    def log_stats(self):
+        logging.info("Prefetch stats: {}".format(self.stats()))
+
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def acer(spoof_probs, labels, threshold=0.5):
+    """
+    Compute the anti-spoofing error rates of a set of predictions.
+
+    params:
+    - spoof_probs (array): predicted probability of spoof for every image
+    - labels (array): ground truth, 1 for spoof and 0 for live
+    - threshold (float): images scoring at or above it are classified as spoof
+    return:
+    - dict with APCER (spoof accepted as live), BPCER (live rejected as spoof) and ACER
+    """
+    spoof_probs = np.asarray(spoof_probs, dtype=np.float64)
+    labels = np.asarray(labels).astype(bool)
+    predicted_spoof = spoof_probs >= threshold
+    apcer = float(np.mean(~predicted_spoof[labels])) if labels.any() else 0.0
+    bpcer = float(np.mean(predicted_spoof[~labels])) if (~labels).any() else 0.0
+    return {'APCER': apcer, 'BPCER': bpcer, 'ACER': (apcer + bpcer) / 2}
+
+
+def score_drift(reference, candidate, labels=None, threshold=0.5):
+    """
+    Summarise how far the spoof probabilities of a candidate model drift from a reference model.
+
+    params:
+    - reference (array): spoof probabilities of the reference model
+    - candidate (array): spoof probabilities of the candidate model, same images and order
+    - labels (array): optional ground truth, adds the ACER of both models and its change
+    return:
+    - dict of drift statistics
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    diff = np.abs(reference - candidate)
+    report = {
+        'images': int(reference.size),
+        'max_abs_drift': float(diff.max()) if diff.size else 0.0,
+        'mean_abs_drift': float(diff.mean()) if diff.size else 0.0,
+        'p99_abs_drift': float(np.percentile(diff, 99)) if diff.size else 0.0,
+        'decision_flips': int(np.sum((reference >= threshold) != (candidate >= threshold))),
+    }
+    if labels is not None:
+        report['reference'] = acer(reference, labels, threshold)
+        report['candidate'] = acer(candidate, labels, threshold)
+        report['ACER_change'] = report['candidate']['ACER'] - report['reference']['ACER']
+    return report
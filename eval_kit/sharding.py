@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from io import BytesIO
+
+from eval_kit.output import OutputWriter, S3MultipartSink, read_output
+
+
+# Number of images per shard of a sharded evaluation job.
+SHARD_SIZE = int(os.environ.get('CELEBASPOOF_SHARD_SIZE', 4096))
+# A node renews the lease of its shard while scoring it, a lease not renewed for this many
+# seconds is taken to belong to a dead node and its shard is reassigned.
+LEASE_SECONDS = float(os.environ.get('CELEBASPOOF_SHARD_LEASE_SECONDS', 300))
+# Idle nodes also take over shards claimed longer ago than this, so a slow node does not hold
+# up the job. Both copies write the same output, the first one to finish wins.
+STRAGGLER_SECONDS = float(os.environ.get('CELEBASPOOF_SHARD_STRAGGLER_SECONDS', 1800))
+# Seconds between two looks at the shard board while waiting for other nodes.
+POLL_SECONDS = float(os.environ.get('CELEBASPOOF_SHARD_POLL_SECONDS', 10))
+SHARD_PREFIX = 'shards/'
+
+
+def split_shards(image_list, shard_size=SHARD_SIZE):
+    """
+    Split an image list into consecutive shards, the same on every node given the same list.
+
+    return:
+    - list of lists of image ids
+    """
+    return [image_list[start:start + shard_size] for start in range(0, len(image_list), shard_size)]
+
+
+def board_key(shards, fingerprint=None):
+    """
+    return:
+    - hash of the model fingerprint and of the image ids of every shard, in order, so a job
+      rerun with another model, decode config, image list or shard size gets a board of its own
+    """
+    h = hashlib.sha256('{}\n{}'.format(fingerprint or '', [len(shard) for shard in shards]).encode('utf-8'))
+    for shard in shards:
+        for image_id in shard:
+            h.update(b'\n' + image_id.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+class ShardBoard(object):
+    """
+    Lease-based assignment of the shards of an evaluation job to the nodes scoring it, kept in
+    the object store under <prefix><job_name>/<key>/ so that nodes only need the shared S3 bucket,
+    with key from board_key:
+
+        lease/<shard>.json    {"node": ..., "claimed": ..., "expires": ...} of the node scoring it
+        output/<shard>.bin    the scores of the shard, written by OutputWriter once it is done
+
+    The coordinator clears the board once the merged output is uploaded.
+
+    S3 has no atomic test-and-set, so two nodes may occasionally score the same shard, e.g. when
+    they claim it at the same moment or one takes over from a straggler. Scoring is deterministic,
+    so the duplicate only costs time. Leases compare wall clocks, nodes are expected to be in sync.
+    """
+
+    def __init__(self, s3_client, s3_bucket, job_name, num_shards, node_id, key='', prefix=SHARD_PREFIX,
+                 lease_seconds=LEASE_SECONDS, straggler_seconds=STRAGGLER_SECONDS, poll_seconds=POLL_SECONDS):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.root = os.path.join(prefix, job_name, key)
+        self.num_shards = num_shards
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.straggler_seconds = straggler_seconds
+        self.poll_seconds = poll_seconds
+        self._done = set()
+
+    def _lease_path(self, shard):
+        return os.path.join(self.root, 'lease', '{:06d}.json'.format(shard))
+
+    def output_path(self, shard):
+        return os.path.join(self.root, 'output', '{:06d}.bin'.format(shard))
+
+    def _read(self, path):
+        f = BytesIO()
+        try:
+            self.s3_client.download_fileobj(self.s3_bucket, path, f)
+        except Exception:
+            return None
+        return f.getvalue()
+
+    def read_lease(self, shard):
+        data = self._read(self._lease_path(shard))
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def _write_lease(self, shard, claimed):
+        now = time.time()
+        lease = {'node': self.node_id, 'claimed': claimed, 'expires': now + self.lease_seconds}
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=self._lease_path(shard),
+                                  Body=json.dumps(lease).encode('utf-8'))
+
+    def is_done(self, shard):
+        if shard in self._done:
+            return True
+        try:
+            self.s3_client.head_object(Bucket=self.s3_bucket, Key=self.output_path(shard))
+        except Exception:
+            return False
+        self._done.add(shard)
+        return True
+
+    def _claimable(self, shard, now):
+        lease = self.read_lease(shard)
+        if lease is None:
+            return 'free'
+        if lease['node'] == self.node_id:
+            # e.g. this node restarted, pick its shard back up
+            return 'free'
+        if lease['expires'] < now:
+            return 'expired'
+        if now - lease['claimed'] > self.straggler_seconds:
+            return 'straggler'
+        return None
+
+    def claim(self):
+        """
+        Claim the next shard to score: free shards first, then the ones of dead or slow nodes.
+        Waits while every remaining shard is being scored by a live node.
+
+        return:
+        - shard index, or None once every shard is done
+        """
+        while True:
+            now = time.time()
+            remaining = [shard for shard in range(self.num_shards) if not self.is_done(shard)]
+            if not remaining:
+                return None
+            states = [(shard, self._claimable(shard, now)) for shard in remaining]
+            for wanted in ('free', 'expired', 'straggler'):
+                for shard, state in states:
+                    if state != wanted:
+                        continue
+                    self._write_lease(shard, now)
+                    lease = self.read_lease(shard)
+                    if lease is None or lease['node'] != self.node_id:
+                        # another node claimed it at the same time
+                        continue
+                    if wanted != 'free':
+                        logging.info("Node {} takes over {} shard {}".format(self.node_id, wanted, shard))
+                    return shard
+            logging.info("Node {}: {} shards still running on other nodes, waiting".format(
+                self.node_id, len(remaining)))
+            time.sleep(self.poll_seconds)
+
+    def renew(self, shard):
+        """
+        Extend the lease of a shard this node is scoring, unless another node took it over.
+        """
+        lease = self.read_lease(shard)
+        if lease is not None and lease['node'] != self.node_id:
+            return
+        claimed = lease['claimed'] if lease is not None else time.time()
+        self._write_lease(shard, claimed)
+
+    def open_output(self, shard, output_format='compact', compress=False):
+        """
+        Open the writer of the scores of a shard, the shard is done once it is closed.
+        Shard outputs are only read back by merge, so they default to the compact format.
+        """
+        sink = S3MultipartSink(self.s3_client, self.s3_bucket, self.output_path(shard))
+        return OutputWriter(sink, output_format, compress)
+
+    def wait_all(self, timeout=None):
+        """
+        Wait until every shard is done, taking no part in the scoring.
+        """
+        st = time.time()
+        while True:
+            remaining = [shard for shard in range(self.num_shards) if not self.is_done(shard)]
+            if not remaining:
+                return
+            if timeout is not None and time.time() - st > timeout:
+                raise RuntimeError("{} shards not done after {}s: {}".format(len(remaining), timeout, remaining))
+            logging.info("Waiting for {} shards".format(len(remaining)))
+            time.sleep(self.poll_seconds)
+
+    def merge(self, shards):
+        """
+        Read the outputs of every shard.
+
+        params:
+        - shards (list): the image ids of every shard, from split_shards
+        return:
+        - dict of image_id -> spoof probability in image list order
+        """
+        output_probs = {}
+        for shard, image_ids in enumerate(shards):
+            probs = read_output(self._read(self.output_path(shard)))
+            missing = [image_id for image_id in image_ids if image_id not in probs]
+            if missing:
+                raise ValueError("Shard {} misses {} images, e.g. {}".format(shard, len(missing), missing[0]))
+            for image_id in image_ids:
+                output_probs[image_id] = probs[image_id]
+        return output_probs
+
+    def clear(self):
+        """
+        Remove the leases and outputs of every shard once the merged output is uploaded, so that
+        a later job of the same name scores everything again. Nodes waiting in claim() are given
+        two polls to see every shard done before the outputs go.
+        """
+        time.sleep(2 * self.poll_seconds)
+        for shard in range(self.num_shards):
+            for path in (self._lease_path(shard), self.output_path(shard)):
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=path)
+        self._done = set()
+        logging.info("Shard board {} cleared".format(self.root))
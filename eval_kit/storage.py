@@ -0,0 +1,109 @@
+import mmap
+import os
+import tempfile
+import threading
+
+from abc import ABC, abstractmethod
+from io import BytesIO
+
+
+class Storage(ABC):
+    """
+    Read-only object store the image iterator fetches the image list and the images from.
+    Keys are '/' separated paths, e.g. 'test_data/494405.png'. Implementations must be
+    thread safe, objects are read concurrently by the fetch workers.
+    """
+
+    @abstractmethod
+    def read(self, key):
+        """
+        return:
+        - bytes of the object
+        """
+        pass
+
+    def read_lines(self, key):
+        """
+        return:
+        - the non-empty lines of a text object, e.g. an image list
+        """
+        lines = bytes(self.read(key)).decode('utf-8').split('\n')
+        return [x.strip() for x in lines if x.strip()]
+
+    def map(self, key):
+        """
+        Make a large object, e.g. an image pack, available as one buffer that can be sliced without copies.
+
+        return:
+        - read-only buffer (mmap, bytes or memoryview) of the whole object
+        """
+        return self.read(key)
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        # the mapping stays valid once the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class S3Storage(Storage):
+    """
+    Objects of an S3 bucket, read with a shared boto3 client (or eval_kit.local_s3.LocalS3Client).
+    """
+
+    def __init__(self, s3_client, s3_bucket):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+
+    def read(self, key):
+        f = BytesIO()
+        self.s3_client.download_fileobj(self.s3_bucket, key, f)
+        return f.getvalue()
+
+    def map(self, key):
+        # download_file fetches large objects with concurrent range requests,
+        # the file is unlinked right away and lives on as long as its mapping
+        fd, path = tempfile.mkstemp(prefix='celebaspoof_', suffix='.pack')
+        os.close(fd)
+        try:
+            self.s3_client.download_file(self.s3_bucket, key, path)
+            return _map_file(path)
+        finally:
+            os.remove(path)
+
+
+class LocalStorage(Storage):
+    """
+    Files of a local directory, keys are paths relative to root (or absolute paths).
+    """
+
+    def __init__(self, root='.'):
+        self.root = root
+
+    def read(self, key):
+        with open(os.path.join(self.root, key), 'rb') as f:
+            return f.read()
+
+    def map(self, key):
+        return _map_file(os.path.join(self.root, key))
+
+
+class MemoryStorage(Storage):
+    """
+    Objects held in a dict, to test and benchmark the image iterator without disk or network access.
+    """
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = data
+
+    def read(self, key):
+        with self._lock:
+            try:
+                return self.objects[key]
+            except KeyError:
+                raise FileNotFoundError(key)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from eval_kit.metrics import metrics
+
+
+# Directory of the preprocessed-tensor stores, off unless it is set. The first run over an image
+# list writes the resized model inputs there, later runs on the same list and preprocessing
+# config feed them to the detector without reading, decoding or resizing any image.
+TENSOR_STORE_DIR = os.environ.get('CELEBASPOOF_TENSOR_STORE_DIR')
+
+
+def store_key(image_list, config):
+    """
+    return:
+    - hash of the image ids, in order, and of the preprocessing config
+    """
+    h = hashlib.sha256(config.encode('utf-8'))
+    for image_id in image_list:
+        h.update(b'\n' + image_id.encode('utf-8'))
+    return h.hexdigest()
+
+
+class TensorStore(object):
+    """
+    The images of an image list as the detector sees them after decoding and resizing, kept as
+    one (N, H, W, 3) uint8 array in <store_dir>/<key>/images.npy with the image id of every row
+    in <store_dir>/<key>/ids.json. The key covers the image list and the preprocessing config,
+    e.g. CelebASpoofDetector.preprocess_fingerprint() + client.decode_config(), so any change
+    to either starts a new store.
+
+    fill() writes the store during a normal run and only publishes it once every image of the
+    list went through it: a run that is interrupted, resumed from a journal or partly served
+    by the prediction cache leaves no store behind. iter_batches() then yields batches sliced
+    straight out of the memory-mapped array.
+    """
+
+    def __init__(self, image_list, config, store_dir=TENSOR_STORE_DIR):
+        self.image_list = list(image_list)
+        self.path = os.path.join(store_dir, store_key(self.image_list, config))
+        self.exists = os.path.exists(os.path.join(self.path, 'ids.json'))
+
+    def iter_batches(self, batch_policy, skip_ids=None):
+        """
+        params:
+        - batch_policy (eval_kit.batching.BatchPolicy): read before every batch, so an autotuned size applies
+        - skip_ids (set): images that are not yielded, e.g. the ones already in the journal
+        return: tuple(image_id: numpy.array, images: numpy.array)
+        """
+        with open(os.path.join(self.path, 'ids.json')) as f:
+            image_ids = json.load(f)
+        # copy-on-write, so the detector gets writable arrays without touching the file
+        images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='c')
+        rows = [row for row, image_id in enumerate(image_ids) if not skip_ids or image_id not in skip_ids]
+        logging.info("Tensor store {}: {} of {} images of shape {}".format(
+            self.path, len(rows), len(image_ids), images.shape[1:]))
+        start = 0
+        while start < len(rows):
+            batch_rows = rows[start:start + batch_policy.batch_size(images.shape[1:])]
+            start += len(batch_rows)
+            with metrics.time('store_read', len(batch_rows)):
+                if batch_rows[-1] - batch_rows[0] + 1 == len(batch_rows):
+                    batch = images[batch_rows[0]:batch_rows[-1] + 1]
+                else:
+                    batch = images[batch_rows]
+            yield np.array([image_ids[row] for row in batch_rows]), batch
+
+    def fill(self, image_iter, resize):
+        """
+        Resize the batches of image_iter into the store and yield them resized.
+
+        params:
+        - image_iter: iterator of (image_ids, images), e.g. client.get_image
+        - resize: CelebASpoofDetector.resize_images
+        return: tuple(image_id: numpy.array, images: numpy.array)
+        """
+        rows = {image_id: row for row, image_id in enumerate(self.image_list)}
+        filled = np.zeros(len(self.image_list), dtype=bool)
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        images = None
+        try:
+            for image_ids, batch in image_iter:
+                with metrics.time('store_resize', len(batch)):
+                    batch = resize(batch)
+                if images is None:
+                    os.makedirs(tmp_path, exist_ok=True)
+                    images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+',
+                                                       dtype=np.uint8, shape=(len(self.image_list),) + batch.shape[1:])
+                batch_rows = [rows[image_id] for image_id in image_ids]
+                images[batch_rows] = batch
+                filled[batch_rows] = True
+                yield image_ids, batch
+
+            if images is None or not filled.all():
+                logging.info("Tensor store not written, {} of {} images went through the detector".format(
+                    int(filled.sum()), len(self.image_list)))
+                return
+            images.flush()
+            with open(os.path.join(tmp_path, 'ids.json'), 'w') as f:
+                json.dump(self.image_list, f)
+            if not os.path.exists(self.path):
+                os.rename(tmp_path, self.path)
+                self.exists = True
+                logging.info("Tensor store written to {}, {} images of shape {}".format(
+                    self.path, len(self.image_list), images.shape[1:]))
+        finally:
+            del images
+            shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,82 @@
+import logging
+import os
+
+import torch
+
+# torch >= 2.5 can export through torch.export ('dynamo'), which only targets recent opsets and
+# writes the weights to a separate '<file>.data' named after the temp file of _atomic_save.
+# The TorchScript-based exporter honours opset_version and keeps the weights inside the graph.
+_ONNX_DYNAMO = 'dynamo' in torch.onnx.export.__code__.co_varnames
+
+def is_fresh(artifact_path, source_path):
+    """
+    Whether artifact_path exists and is newer than the file it was built from.
+    """
+    if not os.path.exists(artifact_path):
+        return False
+    if not os.path.exists(source_path):
+        return True
+    return os.path.getmtime(artifact_path) > os.path.getmtime(source_path)
+
+
+def _atomic_save(save, path):
+    # write next to the destination and rename, so concurrent readers never see a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _optimize(module):
+    # the optimised graph may hold prepacked ops that cannot be serialised,
+    # so it is only applied in memory after saving or loading the frozen module
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        module = torch.jit.optimize_for_inference(module)
+    return module
+
+
+def export_torchscript(net, path, size=224, device='cpu'):
+    """
+    Trace an eval-mode network, freeze it and save it to path.
+
+    params:
+        - net (nn.Module): network mapping (N, 3, size, size) images to logits
+        - path (str): destination of the TorchScript artifact
+    return:
+        - the frozen ScriptModule with the inference-time graph optimisations
+          available in this torch version applied
+    """
+    net.eval()
+    example = torch.zeros(1, 3, size, size, device=device)
+    with torch.no_grad():
+        module = torch.jit.trace(net, example)
+    if hasattr(torch.jit, 'freeze'):
+        module = torch.jit.freeze(module)
+    _atomic_save(lambda p: torch.jit.save(module, p), path)
+    logging.info("Exported TorchScript model to {}".format(path))
+    return _optimize(module)
+
+
+def load_torchscript(path, device='cpu'):
+    """
+    Load an artifact written by export_torchscript, ready for inference.
+    """
+    module = torch.jit.load(path, map_location=device)
+    module.eval()
+    return _optimize(module)
+
+
+def export_onnx(net, path, size=224, opset_version=11):
+    """
+    Export the live/spoof path of an eval-mode network to ONNX with a dynamic batch dimension.
+    The graph takes 'input' of shape (N, 3, size, size) and returns 'logits' of shape (N, 2).
+    """
+    net.eval()
+    device = next(net.parameters()).device
+    example = torch.zeros(1, 3, size, size, device=device)
+    kwargs = {'dynamo': False} if _ONNX_DYNAMO else {}
+    with torch.no_grad():
+        _atomic_save(lambda p: torch.onnx.export(
+            net, example, p, input_names=['input'], output_names=['logits'],
+            dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=opset_version, **kwargs), path)
+    logging.info("Exported ONNX model to {}".format(path))
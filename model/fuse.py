@@ -0,0 +1,50 @@
+import torch
+import torch.nn as nn
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Fold a BatchNorm in eval mode into the preceding convolution.
+
+    params:
+        - conv (nn.Conv2d)
+        - bn (nn.BatchNorm2d): applied to the output of conv, with frozen statistics
+    return:
+        - nn.Conv2d with bias computing bn(conv(x))
+    """
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size,
+                      stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                      groups=conv.groups, bias=True).to(conv.weight.device)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def _fuse_pair(module, conv_name, bn_name):
+    bn = getattr(module, bn_name, None)
+    if isinstance(bn, nn.BatchNorm2d):
+        setattr(module, conv_name, fuse_conv_bn(getattr(module, conv_name), bn))
+        setattr(module, bn_name, nn.Identity())
+
+
+def fuse_aenet(model):
+    """
+    Fold every BatchNorm of an AENet into its convolution: the stem, the BasicBlock or
+    Bottleneck convolutions and the downsample branches. The folded BatchNorms become
+    nn.Identity, so the module tree and the remaining state_dict keys stay the same.
+    The model must be in eval mode since the running statistics are baked in.
+    """
+    if model.training:
+        raise ValueError("Call model.eval() before fusing BatchNorm layers")
+    _fuse_pair(model, 'conv1', 'bn1')
+    for layer in (model.layer1, model.layer2, model.layer3, model.layer4):
+        for block in layer:
+            for idx in (1, 2, 3):
+                _fuse_pair(block, 'conv{}'.format(idx), 'bn{}'.format(idx))
+            if block.downsample is not None:
+                _fuse_pair(block.downsample, '0', '1')
+    model.fused = True
+    return model
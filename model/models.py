@@ -96,7 +96,7 @@ class Bottleneck(nn.Module):
 # AENet is based on ResNet-18
 class AENet(nn.Module):
 
-    def __init__(self, block=BasicBlock, layers=[2, 2, 2, 2], num_classes=1000, sync_stats=False):
+    def __init__(self, block=BasicBlock, layers=[2, 2, 2, 2], num_classes=1000, sync_stats=False, inference_only=False):
         
         global BN
 
@@ -141,6 +141,19 @@ class AENet(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
+        if inference_only:
+            self.strip_auxiliary_heads()
+
+    def strip_auxiliary_heads(self):
+        """
+        Drop the semantic classifiers and the depth/reflection embeddings, which are only
+        needed for training, keeping the live/spoof path. Call it before exporting a model
+        for deployment, checkpoints still load since their extra keys are skipped.
+        """
+        for name in ('fc_live_attribute', 'fc_attack', 'fc_light', 'depth_final', 'reflect_final'):
+            if hasattr(self, name):
+                delattr(self, name)
+
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
@@ -158,8 +171,7 @@ class AENet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-
+    def features(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -169,7 +181,18 @@ class AENet(nn.Module):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
-
+        return x
+
+    def _require_auxiliary_heads(self):
+        if not hasattr(self, 'depth_final'):
+            raise RuntimeError("auxiliary heads were stripped, build AENet with inference_only=False to compute them")
+
+    def auxiliary_maps(self, x):
+        """
+        Depth and reflection maps (14x14) of the backbone features x.
+        Raises RuntimeError once the auxiliary heads were stripped.
+        """
+        self._require_auxiliary_heads()
         depth_map = self.depth_final(x)
         reflect_map = self.reflect_final(x)
 
@@ -179,20 +202,48 @@ class AENet(nn.Module):
 
         reflect_map = self.sigmoid(reflect_map)
         reflect_map = self.upsample14(reflect_map)
+        return depth_map, reflect_map
+
+    def forward(self, x, return_aux=False):
+        """
+        Only the live/spoof logits are computed by default.
+        With return_aux=True, return (x_live, depth_map, reflect_map) instead, which needs the
+        auxiliary heads: it raises RuntimeError on a net built with inference_only=True or
+        after strip_auxiliary_heads().
+        """
+        if return_aux:
+            self._require_auxiliary_heads()
+        x = self.features(x)
+
+        if return_aux:
+            depth_map, reflect_map = self.auxiliary_maps(x)
 
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
 
-
-        x_live_attribute = self.fc_live_attribute(x)
-        x_attack = self.fc_attack(x)
-        x_light = self.fc_light(x)
         x_live = self.fc_live(x)
 
+        if return_aux:
+            return x_live, depth_map, reflect_map
+        return x_live
 
+    def forward_all(self, x):
+        """
+        Run every head, return (x_live, x_live_attribute, x_attack, x_light, depth_map, reflect_map).
+        Raises RuntimeError on a net built with inference_only=True or after strip_auxiliary_heads().
+        """
+        self._require_auxiliary_heads()
+        x = self.features(x)
+        depth_map, reflect_map = self.auxiliary_maps(x)
 
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
 
-        return x_live
+        x_live_attribute = self.fc_live_attribute(x)
+        x_attack = self.fc_attack(x)
+        x_light = self.fc_light(x)
+        x_live = self.fc_live(x)
+        return x_live, x_live_attribute, x_attack, x_light, depth_map, reflect_map
 
 
 
@@ -50,11 +50,11 @@ class ConsensusModule(torch.nn.Module):
 
     def forward(self, input):
         if self.consensus_type == 'avg':
-            consensus_tensor = torch.tensor(0).cuda()
+            consensus_tensor = torch.tensor(0, device=input.device)
         elif self.consensus_type == 'identity':
-            consensus_tensor = torch.tensor(1).cuda()
+            consensus_tensor = torch.tensor(1, device=input.device)
         else:
-            consensus_tensor = torch.tensor(2).cuda()
-        dim_tensor = torch.tensor(self.dim).cuda()
+            consensus_tensor = torch.tensor(2, device=input.device)
+        dim_tensor = torch.tensor(self.dim, device=input.device)
         f = SegmentConsensus.apply
         return f(input, consensus_tensor, dim_tensor) ## str, int -> tensor
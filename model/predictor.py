@@ -1,14 +1,81 @@
 from PIL import Image
+import logging
+import os
+import queue
 import sys
+import time
+import traceback
 import numpy as np
 import torchvision
 import torch
+import torch.nn.functional as F
 
 from models import AENet
+from export import export_onnx, export_torchscript, is_fresh, load_torchscript
+from fuse import fuse_aenet
+from quantize import QUANT_BACKEND, quantize_dynamic
+from weights import load_flat_weights
 from ops import ConsensusModule
 
 sys.path.append('..')
+from eval_kit.cache import file_fingerprint
 from eval_kit.detector import CelebASpoofDetector
+from eval_kit.metrics import metrics
+
+# torch >= 1.11 can antialias bilinear downsampling the way PIL does,
+# older versions keep the per-image PIL preprocessing to avoid changing scores.
+_ANTIALIAS = 'antialias' in F.interpolate.__code__.co_varnames
+# Side of the square images the network takes.
+INPUT_SIZE = 224
+# 'tensor' resizes the whole batch at once with torch, 'pil' resizes image by image with PIL.
+PREPROCESS = os.environ.get('CELEBASPOOF_PREPROCESS', 'tensor' if _ANTIALIAS else 'pil')
+# 'cpu', 'cuda' or 'cuda:<n>', defaults to the first GPU when there is one and CPU otherwise.
+DEVICE = os.environ.get('CELEBASPOOF_DEVICE')
+# Number of intra-op threads used by torch on CPU, defaults to torch's own choice.
+NUM_THREADS = int(os.environ.get('CELEBASPOOF_NUM_THREADS', 0))
+# Fold BatchNorm into the convolutions once the weights are loaded, set to 0 to keep them apart.
+FUSE_BN = os.environ.get('CELEBASPOOF_FUSE_BN', '1') != '0'
+# 'fp32' runs the float network, 'int8' the quantized one built by tools/quantize_model.py.
+MODE = os.environ.get('CELEBASPOOF_MODE', 'fp32')
+MODES = ('fp32', 'int8')
+CHECKPOINT_PATH = './model/ckpt_iter_27000.pth.tar'
+INT8_PATH = './model/aenet_int8.pt'
+# Load the fp32 network from a frozen TorchScript artifact newer than the checkpoint,
+# exporting one when it is missing or stale. Set to 0 to always build the eager network.
+TORCHSCRIPT = os.environ.get('CELEBASPOOF_TORCHSCRIPT', '1') != '0'
+TORCHSCRIPT_PATH = './model/aenet_fp32_{fused}_{device}.ts.pt'
+ONNX_PATH = './model/aenet.onnx'
+# Inference-only weights written by tools/convert_checkpoint.py, memory-mapped instead of
+# unpickling the training checkpoint when they are newer than it.
+WEIGHTS_PATH = './model/aenet_weights.bin'
+# Number of processes ParallelAENetPredictor shards every batch across.
+INFER_WORKERS = int(os.environ.get('CELEBASPOOF_INFER_WORKERS', 0))
+# Batches are not split into chunks smaller than this, tiny forwards waste the workers.
+MIN_CHUNK = 8
+
+
+def select_device(device=None):
+    """
+    Resolve the device to run on, falling back to CPU on hosts without a GPU.
+    """
+    device = device or DEVICE
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+def _resize_tensor(images, size):
+    """
+    return:
+    - float tensor of shape (N, 3, size, size) holding the uint8 values of the resized images
+    """
+    data = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float()
+    if data.shape[2:] != (size, size):
+        kwargs = {'antialias': True} if _ANTIALIAS else {}
+        data = F.interpolate(data, size=(size, size), mode='bilinear', align_corners=False, **kwargs)
+        # PIL rounds the resized image to uint8 before ToTensor
+        data = data.round_().clamp_(0, 255)
+    return data
+
 
 def pretrain(model, state_dict):
     own_state = model.state_dict()
@@ -30,23 +97,100 @@ def pretrain(model, state_dict):
 
 class AENetPredictor(CelebASpoofDetector):
 
-    def __init__(self):
+    def __init__(self, device=None, num_threads=None, fuse_bn=None, mode=None, torchscript=None, net=None):
+        self.mode = mode or MODE
+        if self.mode not in MODES:
+            raise ValueError("Unknown predictor mode {}, expected one of {}".format(self.mode, MODES))
+        if self.mode == 'int8':
+            # quantized kernels only run on CPU
+            device = 'cpu'
+        self.device = select_device(device)
+        num_threads = num_threads or NUM_THREADS
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
         self.num_class = 2
-        self.net = AENet(num_classes = self.num_class)
-        checkpoint = torch.load('./model/ckpt_iter_27000.pth.tar')
+        self._init_transform()
+        if net is not None:
+            # an already built network, e.g. one shared by ParallelAENetPredictor
+            self.net = net
+            return
+
+        fuse_bn = FUSE_BN if fuse_bn is None else fuse_bn
+        torchscript = TORCHSCRIPT if torchscript is None else torchscript
+        script_path = TORCHSCRIPT_PATH.format(fused='fused' if fuse_bn else 'unfused', device=self.device.type)
+        if self.mode == 'fp32' and torchscript and is_fresh(script_path, CHECKPOINT_PATH):
+            self.net = load_torchscript(script_path, self.device)
+            return
+
+        self.net = self._build_net(fuse_bn)
+        self.net.to(self.device)
+        if self.mode == 'fp32' and torchscript:
+            try:
+                self.net = export_torchscript(self.net, script_path, self.new_width, self.device)
+            except Exception:
+                logging.warning("Failed to export TorchScript model to {}, running eagerly".format(script_path),
+                                exc_info=True)
 
-        pretrain(self.net,checkpoint['state_dict'])
+    @classmethod
+    def fingerprint(cls):
+        extra = '{} mode={} preprocess={} fuse_bn={}'.format(cls.__name__, MODE, PREPROCESS, FUSE_BN)
+        paths = [CHECKPOINT_PATH] + ([INT8_PATH] if MODE == 'int8' and os.path.exists(INT8_PATH) else [])
+        return file_fingerprint(*paths, extra=extra)
 
-        self.new_width = self.new_height = 224
+    @classmethod
+    def preprocess_fingerprint(cls):
+        return 'size={} preprocess={} antialias={}'.format(INPUT_SIZE, PREPROCESS, _ANTIALIAS)
+
+    @classmethod
+    def resize_images(cls, images):
+        # the same pixels preprocess_data and preprocess_batch feed the network, which
+        # leave images already at the input size untouched
+        if PREPROCESS == 'pil':
+            return np.stack([np.asarray(Image.fromarray(image).resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR))
+                             for image in images])
+        if not (isinstance(images, np.ndarray) and images.ndim == 4):
+            # a batch of mixed shapes, crops rarely share one
+            return np.concatenate([cls.resize_images(image[None]) for image in images])
+        return _resize_tensor(images, INPUT_SIZE).permute(0, 2, 3, 1).to(torch.uint8).numpy()
+
+    def _init_transform(self):
+        self.new_width = self.new_height = INPUT_SIZE
+        self.preprocess = PREPROCESS
 
         self.transform = torchvision.transforms.Compose([
             torchvision.transforms.Resize((self.new_width, self.new_height)),
             torchvision.transforms.ToTensor(),
             ])
 
-        
-        self.net.cuda()
-        self.net.eval()
+    def _build_net(self, fuse_bn):
+        net = AENet(num_classes = self.num_class, inference_only=True)
+        net.eval()
+        meta = None
+        if is_fresh(WEIGHTS_PATH, CHECKPOINT_PATH):
+            meta = load_flat_weights(net, WEIGHTS_PATH)
+            if meta.get('fused') and (not fuse_bn or self.mode == 'int8'):
+                # the BatchNorm layers are needed, rebuild from the checkpoint
+                net = AENet(num_classes = self.num_class, inference_only=True)
+                net.eval()
+                meta = None
+        if meta is None:
+            checkpoint = torch.load(CHECKPOINT_PATH, map_location='cpu')
+            pretrain(net,checkpoint['state_dict'])
+
+        if self.mode == 'int8':
+            net = self._load_int8(net)
+        elif fuse_bn and not getattr(net, 'fused', False):
+            fuse_aenet(net)
+        return net
+
+    def _load_int8(self, net):
+        torch.backends.quantized.engine = QUANT_BACKEND
+        if os.path.exists(INT8_PATH):
+            return torch.jit.load(INT8_PATH, map_location='cpu')
+        logging.warning("No statically quantized model at {}, falling back to dynamic "
+                        "quantization of the fc heads".format(INT8_PATH))
+        return quantize_dynamic(net)
 
 
 
@@ -55,20 +199,173 @@ class AENetPredictor(CelebASpoofDetector):
         processed_data = self.transform(processed_data)
         return processed_data
 
-    def eval_image(self, image):
-        data = torch.stack(image,dim=0)
+    def _resize_batch(self, images):
+        return _resize_tensor(images, self.new_width).div_(255)
+
+    def preprocess_batch(self, images):
+        """
+        Resize and normalise a whole batch with tensor operations, numerically equivalent
+        to stacking preprocess_data of every image (see tools/check_parity.py).
+
+        params:
+            - images: uint8 array of shape (N, H, W, 3), or a list of (H, W, 3) arrays
+        return:
+            - float tensor of shape (N, 3, new_height, new_width)
+        """
+        if isinstance(images, np.ndarray) and images.ndim == 4:
+            return self._resize_batch(images)
+
+        groups = {}
+        for idx, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(idx)
+        data = torch.empty(len(images), 3, self.new_height, self.new_width)
+        for shape, indices in groups.items():
+            data[indices] = self._resize_batch(np.stack([images[i] for i in indices]))
+        return data
+
+    def eval_image(self, data):
         channel = 3
-        input_var = data.view(-1, channel, data.size(2), data.size(3)).cuda()
+        input_var = data.view(-1, channel, data.size(2), data.size(3)).to(self.device, non_blocking=True)
         with torch.no_grad():
             rst = self.net(input_var).detach()
+        if self.device.type == 'cuda':
+            # wait for the kernels so the forward time is measured, not the launch time
+            torch.cuda.synchronize(self.device)
         return rst.reshape(-1, self.num_class)
 
     def predict(self, images):
-        real_data = []
-        for image in images:
-            data = self.preprocess_data(image)
-            real_data.append(data)
-        rst = self.eval_image(real_data)
-        rst = torch.nn.functional.softmax(rst, dim=1).cpu().numpy().copy()
-        probability = np.array(rst)
+        with metrics.time('preprocess', len(images)):
+            if self.preprocess == 'pil':
+                data = torch.stack([self.preprocess_data(image) for image in images], dim=0)
+            else:
+                data = self.preprocess_batch(images)
+        with metrics.time('forward', len(images)):
+            rst = self.eval_image(data)
+        with metrics.time('postprocess', len(images)):
+            rst = torch.nn.functional.softmax(rst, dim=1).cpu().numpy().copy()
+            probability = np.array(rst)
         return probability
+
+
+def _predict_worker(worker_id, net, num_threads, tasks, results):
+    """
+    Worker process of ParallelAENetPredictor: score the chunks of tasks until it receives None.
+    A first (worker_id, None, None, seconds) result tells that the worker is ready.
+    """
+    st = time.time()
+    predictor = AENetPredictor(device='cpu', num_threads=num_threads, mode='fp32', net=net)
+    # the first forward sets up the kernels, keep it out of the timed predict calls
+    predictor.predict(np.zeros((1, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8))
+    results.put((worker_id, None, None, time.time() - st))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, images = task
+        st = time.time()
+        try:
+            if torch.is_tensor(images):
+                images = images.numpy()
+            result = predictor.predict(images)
+        except Exception:
+            result = traceback.format_exc()
+        results.put((worker_id, index, result, time.time() - st))
+
+
+class ParallelAENetPredictor(AENetPredictor):
+    """
+    Shards every batch across worker processes, each running the eager fp32 AENet with its
+    own preprocessing and torch threads, and merges the probabilities back in input order.
+    The network is built once and its weights moved to shared memory, which every worker maps
+    instead of holding a private copy. The busy time of every worker is recorded in
+    eval_kit.metrics as the 'worker<n>' stage, so the report shows per-worker throughput.
+    """
+
+    def __init__(self, workers=None, num_threads=None, fuse_bn=None):
+        super(ParallelAENetPredictor, self).__init__(device='cpu', fuse_bn=fuse_bn, mode='fp32', torchscript=False)
+        workers = workers or INFER_WORKERS or os.cpu_count()
+        num_threads = num_threads or NUM_THREADS or max(1, os.cpu_count() // workers)
+        self.net.share_memory()
+        context = torch.multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = [context.Process(target=_predict_worker, daemon=True,
+                                         args=(i, self.net, num_threads, self._tasks, self._results))
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        # wait for every worker to import torch and warm up, start-up is not part of the runtime
+        for _ in self._workers:
+            self._result()
+        logging.info("Started {} predictor workers with {} threads each".format(workers, num_threads))
+
+    def _result(self):
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                dead = [i for i, worker in enumerate(self._workers) if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError("Predictor workers {} exited".format(dead))
+
+    def predict(self, images):
+        chunks = np.array_split(np.arange(len(images)), max(1, min(len(self._workers), len(images) // MIN_CHUNK)))
+        for index, chunk in enumerate(chunks):
+            part = images[chunk[0]:chunk[-1] + 1]
+            if isinstance(part, np.ndarray):
+                # torch.multiprocessing hands tensors over through shared memory instead of pickling them
+                part = torch.from_numpy(np.ascontiguousarray(part))
+            self._tasks.put((index, part))
+        probs = [None] * len(chunks)
+        for _ in chunks:
+            worker_id, index, result, seconds = self._result()
+            if isinstance(result, str):
+                raise RuntimeError("Predictor worker {} failed:\n{}".format(worker_id, result))
+            metrics.record('worker{}'.format(worker_id), seconds, len(result))
+            probs[index] = result
+        return np.concatenate(probs)
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+
+class ONNXPredictor(AENetPredictor):
+    """
+    Runs the live/spoof path of AENet with ONNX Runtime on CPU, sharing the preprocessing
+    and the (N, 2) probability output of AENetPredictor. The ONNX graph is exported from
+    the checkpoint to ONNX_PATH when it is missing or older than the checkpoint.
+    """
+
+    def __init__(self, num_threads=None, onnx_path=ONNX_PATH):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("ONNXPredictor requires the onnxruntime package")
+
+        self.device = torch.device('cpu')
+        self.num_class = 2
+        self._init_transform()
+
+        if not is_fresh(onnx_path, CHECKPOINT_PATH):
+            net = AENetPredictor(device='cpu', mode='fp32', torchscript=False).net
+            export_onnx(net, onnx_path, self.new_width)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        num_threads = num_threads or NUM_THREADS
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval_image(self, data):
+        channel = 3
+        input_var = data.view(-1, channel, data.size(2), data.size(3)).numpy()
+        rst = self.session.run(None, {self.input_name: input_var})[0]
+        return torch.from_numpy(rst).reshape(-1, self.num_class)
@@ -0,0 +1,114 @@
+import logging
+
+import torch
+import torch.nn as nn
+
+from models import AENet, BasicBlock
+
+
+# fbgemm targets x86 servers, qnnpack targets ARM.
+QUANT_BACKEND = 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+
+class QuantizableBasicBlock(BasicBlock):
+    """
+    BasicBlock whose residual addition goes through FloatFunctional so it can be quantized.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(QuantizableBasicBlock, self).__init__(*args, **kwargs)
+        self.skip_add_relu = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
+
+        out = self.conv2(out)
+        out = self.bn2(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.skip_add_relu.add_relu(out, residual)
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, ['0', '1'], inplace=True)
+
+
+class QuantizableAENet(AENet):
+    """
+    Live/spoof path of AENet with quant/dequant stubs, for post-training static quantization.
+    """
+
+    def __init__(self, num_classes=2):
+        super(QuantizableAENet, self).__init__(block=QuantizableBasicBlock, num_classes=num_classes,
+                                               inference_only=True)
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.features(x)
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        x = self.fc_live(x)
+        return self.dequant(x)
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, ['conv1', 'bn1', 'relu'], inplace=True)
+        for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+            for block in layer:
+                block.fuse_model()
+
+
+def quantize_static(net, calibration_batches, backend=QUANT_BACKEND):
+    """
+    Post-training static quantization of an AENet.
+
+    params:
+        - net (AENet): float network with loaded weights, BatchNorm not fused yet
+        - calibration_batches: iterable of preprocessed float tensors (N, 3, 224, 224)
+        - backend (str): quantized engine, 'fbgemm' or 'qnnpack'
+    return:
+        - quantized QuantizableAENet running on CPU
+    """
+    qnet = QuantizableAENet(num_classes=net.fc_live.out_features)
+    missing, _ = qnet.load_state_dict(net.state_dict(), strict=False)
+    if missing:
+        raise ValueError("Weights missing from the float network: {}".format(missing))
+    qnet.eval()
+    qnet.fuse_model()
+
+    torch.backends.quantized.engine = backend
+    qnet.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(qnet, inplace=True)
+    n = 0
+    with torch.no_grad():
+        for batch in calibration_batches:
+            qnet(batch)
+            n += len(batch)
+    logging.info("Calibrated int8 AENet on {} images".format(n))
+    torch.quantization.convert(qnet, inplace=True)
+    return qnet
+
+
+def quantize_dynamic(net):
+    """
+    Dynamic int8 quantization of the fully connected heads, needs no calibration data.
+    """
+    return torch.quantization.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(qnet, path, size=224):
+    """
+    Save a quantized network as TorchScript so it can be loaded without rebuilding it.
+    """
+    example = torch.zeros(1, 3, size, size)
+    with torch.no_grad():
+        traced = torch.jit.trace(qnet, example)
+    torch.jit.save(traced, path)
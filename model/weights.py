@@ -0,0 +1,101 @@
+import json
+import struct
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from fuse import fuse_aenet
+
+
+# File layout: MAGIC, little-endian uint64 header size, json header, then every tensor as
+# raw bytes at an ALIGNMENT-aligned offset recorded in the header.
+MAGIC = b'AENWGT01'
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_flat_weights(state_dict, path, meta=None):
+    """
+    Write a state_dict as a flat, memory-mappable weights file.
+
+    params:
+        - state_dict (dict): name -> tensor, names without any 'module.' prefix
+        - path (str)
+        - meta (dict): json-serialisable description stored in the header, e.g. {'fused': True}
+    """
+    arrays = [(name, tensor.detach().cpu().contiguous().numpy()) for name, tensor in state_dict.items()]
+    tensors = []
+    offset = 0
+    for name, array in arrays:
+        offset = _align(offset)
+        tensors.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset, 'nbytes': array.nbytes})
+        offset += array.nbytes
+    header = json.dumps({'meta': meta or {}, 'tensors': tensors}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry, (_, array) in zip(tensors, arrays):
+            f.seek(data_start + entry['offset'])
+            f.write(array.tobytes())
+
+
+def read_flat_weights(path):
+    """
+    Memory-map a weights file written by save_flat_weights.
+
+    return:
+        - (meta, dict of name -> numpy array backed by the mapping). The mapping is
+          copy-on-write, pages stay shared between processes until they are written to.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a flat weights file".format(path))
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = _align(len(MAGIC) + 8 + header_size)
+
+    mapping = np.memmap(path, dtype=np.uint8, mode='c')
+    arrays = {}
+    for entry in header['tensors']:
+        start = data_start + entry['offset']
+        raw = mapping[start:start + entry['nbytes']]
+        arrays[entry['name']] = raw.view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+    return header['meta'], arrays
+
+
+def load_flat_weights(model, path):
+    """
+    Point the parameters and buffers of an eval-mode AENet at a memory-mapped weights file,
+    without copying. If the file holds BatchNorm-folded weights, the model is fused first.
+
+    return:
+        - the meta dict of the file
+    """
+    meta, arrays = read_flat_weights(path)
+    if meta.get('fused') and not getattr(model, 'fused', False):
+        fuse_aenet(model)
+
+    missing = set(model.state_dict()) - set(arrays)
+    if missing:
+        raise ValueError("{} misses weights for {}".format(path, sorted(missing)))
+    for name, array in arrays.items():
+        module_name, _, attr = name.rpartition('.')
+        module = model
+        for part in module_name.split('.') if module_name else []:
+            module = getattr(module, part)
+        tensor = torch.from_numpy(array)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+        else:
+            raise ValueError("{} has no parameter or buffer {}".format(type(module).__name__, name))
+    return meta
@@ -17,7 +17,13 @@ import sys
 import logging
 
 import numpy as np
-from eval_kit.client import upload_eval_output, get_image, get_job_name
+from eval_kit.client import BATCH_SIZE, SHARD_COORDINATOR, SHARD_NODE, decode_config, open_eval_output, open_journal, \
+    open_shard_board, open_tensor_store, get_image, get_image_list, get_job_name, iter_tensor_store, upload_eval_output
+from eval_kit.batching import AUTOTUNE, BatchPolicy
+from eval_kit.cache import CACHE_DIR, PredictionCache
+from eval_kit.metrics import metrics
+from eval_kit.prefetch import PREFETCH_DEPTH, PrefetchIterator
+from eval_kit.sharding import split_shards
 
 
 logging.basicConfig(level=logging.INFO)
@@ -25,16 +31,21 @@ logging.basicConfig(level=logging.INFO)
 sys.path.append('model')
 ########################################################################################################
 # Please change this line to include your own detector extending the eval_kit.detector.CelebASpoofDetector base class.
-from predictor import AENetPredictor as CelebASpoofDetector
+from predictor import AENetPredictor, ParallelAENetPredictor, INFER_WORKERS
+CelebASpoofDetector = ParallelAENetPredictor if INFER_WORKERS else AENetPredictor
 ########################################################################################################
 
 
-def evaluate_runtime(detector_class, image_iter, job_name):
+def evaluate_runtime(detector_class, image_iter, job_name, cache=None, journal=None, batch_policy=None):
     """
     Please DO NOT modify this part of code or the eval_kit
     Modification of the evaluation toolkit could result in cancellation of your award.
 
     In this function we create the detector instance. And evaluate the wall time for performing CelebASpoofDetector.
+    With a prediction cache, images the iterator found in the cache are merged into the output.
+    With a journal, scores of previous runs are merged into the output and new ones are journaled batch by batch,
+    the journal is cleared once the output is uploaded.
+    With CELEBASPOOF_AUTOTUNE set, batch_policy (shared with the image iterator) is tuned on the detector.
     """
 
     # initialize the detector
@@ -45,42 +56,174 @@ def evaluate_runtime(detector_class, image_iter, job_name):
         # send errors to the eval frontend
         raise
     logging.info("Detector initialized.")
+    if batch_policy is not None and AUTOTUNE:
+        # the iterator picks the tuned size up from its next batch
+        batch_policy.autotune(detector)
+    if hasattr(image_iter, 'start'):
+        # the prefetch thread is held back while the autotune times the detector
+        image_iter.start()
 
 
     # run the images one-by-one and get runtime
-    output_probs = {}
-    output_times = {}
     eval_cnt = 0
+    # outputs are uploaded in parts as batches finish, nothing is kept per image
+    output_writer = open_eval_output(job_name)
 
-    logging.info("Starting runtime evaluation")
-    for image_id, image in image_iter:
-        time_before = time.time()
-        try:
-            prob = detector.predict(image)
-            # assert isinstance(prob, float)
-            for idx,i in enumerate(image_id):
-                output_probs[i] = float(prob[idx][1])
-        except:
-            # send errors to the eval frontend
-            logging.error("Image id failed: {}".format(image_id))
-            raise
-
-        eval_cnt += len(image)
+    try:
+        if journal is not None and journal.completed:
+            output_writer.add(list(journal.completed), list(journal.completed.values()))
+            logging.info("Resuming job {}, {} images restored from the journal".format(
+                job_name, len(journal.completed)))
+
+        def record_cache_hits():
+            if cache is not None:
+                hits = cache.pop_hits()
+                output_writer.add(list(hits), list(hits.values()))
+                if journal is not None:
+                    journal.append(list(hits), list(hits.values()))
+
+        logging.info("Starting runtime evaluation")
+        for image_id, image in image_iter:
+            time_before = time.time()
+            try:
+                prob = detector.predict(image)
+                metrics.record('predict', time.time() - time_before, len(image))
+                # assert isinstance(prob, float)
+                # the live probability of every image, prob may be any (N, 2) sequence
+                live_probs = np.asarray(prob)[:, 1]
+                output_writer.add(image_id, live_probs)
+                if cache is not None:
+                    cache.store(image_id, live_probs)
+                if journal is not None:
+                    journal.append(image_id, live_probs)
+                record_cache_hits()
+            except:
+                # send errors to the eval frontend
+                logging.error("Image id failed: {}".format(image_id))
+                raise
+
+            eval_cnt += len(image)
+
+            if eval_cnt % 5 == 0:
+                logging.info("Finished {} images".format(eval_cnt))
+
+
+
+        if hasattr(image_iter, 'log_stats'):
+            image_iter.log_stats()
+        if hasattr(detector, 'close'):
+            detector.close()
+        record_cache_hits()
+        if cache is not None:
+            cache.log_stats()
+        if journal is not None:
+            journal.close()
+    except:
+        # a failed job leaves no incomplete multipart upload behind, the journal lets a rerun resume
+        output_writer.abort()
+        raise
 
-        if eval_cnt % 5 == 0:
-            logging.info("Finished {} images".format(eval_cnt))
+    logging.info("All images finished, uploading evaluation outputs for evaluation.")
+    # send evaluation output to the server
+    output_writer.close()
+    logging.info("output uploaded for job {}".format(job_name))
+    if journal is not None:
+        # the job is done, a later job of the same name scores everything again
+        journal.clear()
+    metrics.log_report()
 
 
+def evaluate_shards(detector_class, job_name, board, shards, cache=None, batch_policy=None, coordinator=False):
+    """
+    Score the shards claimed from board (eval_kit.sharding.ShardBoard) until every shard is done.
+    Every shard is written to its own output, the coordinator then merges them into the job output
+    and clears the board.
 
-    logging.info("All images finished, uploading evaluation outputs for evaluation.")
-    # send evaluation output to the server
-    upload_eval_output(output_probs, job_name)
+    params:
+    - shards (list): the image ids of every shard, from split_shards
+    """
+    logging.info("Initializing detector.")
+    detector = detector_class()
+    logging.info("Detector initialized.")
+    if batch_policy is not None and AUTOTUNE:
+        batch_policy.autotune(detector)
+
+    while True:
+        shard = board.claim()
+        if shard is None:
+            break
+        logging.info("Node {} scoring shard {}, {} images".format(board.node_id, shard, len(shards[shard])))
+        output_writer = board.open_output(shard)
+        image_iter = PrefetchIterator(get_image(cache=cache, batch_policy=batch_policy, image_list=shards[shard],
+                                                prefetch_depth=PREFETCH_DEPTH), PREFETCH_DEPTH)
+        renewed = time.time()
+        try:
+            for image_id, image in image_iter:
+                time_before = time.time()
+                prob = detector.predict(image)
+                metrics.record('predict', time.time() - time_before, len(image))
+                live_probs = np.asarray(prob)[:, 1]
+                output_writer.add(image_id, live_probs)
+                if cache is not None:
+                    cache.store(image_id, live_probs)
+                    hits = cache.pop_hits()
+                    output_writer.add(list(hits), list(hits.values()))
+                if time.time() - renewed > board.lease_seconds / 3:
+                    board.renew(shard)
+                    renewed = time.time()
+            if cache is not None:
+                hits = cache.pop_hits()
+                output_writer.add(list(hits), list(hits.values()))
+        except:
+            # the lease expires and another node scores the shard again
+            output_writer.abort()
+            raise
+        output_writer.close()
+        logging.info("Node {} finished shard {}".format(board.node_id, shard))
+
+    if hasattr(detector, 'close'):
+        detector.close()
+    if cache is not None:
+        cache.log_stats()
+    if coordinator:
+        board.wait_all()
+        logging.info("All shards finished, uploading evaluation outputs for evaluation.")
+        upload_eval_output(board.merge(shards), job_name)
+        # the job is done, a later job of the same name scores everything again
+        board.clear()
+    metrics.log_report()
 
 
 if __name__ == '__main__':
     job_name = get_job_name()
-    celebA_spoof_image_iter = get_image()
-    evaluate_runtime(CelebASpoofDetector, celebA_spoof_image_iter, job_name)
+    cache = None
+    fingerprint = CelebASpoofDetector.fingerprint()
+    if fingerprint:
+        fingerprint += decode_config()
+    if fingerprint and CACHE_DIR:
+        cache = PredictionCache(fingerprint)
+    batch_policy = BatchPolicy(BATCH_SIZE)
+    if SHARD_NODE:
+        shards = split_shards(get_image_list())
+        board = open_shard_board(job_name, shards, fingerprint)
+        evaluate_shards(CelebASpoofDetector, job_name, board, shards, cache, batch_policy, SHARD_COORDINATOR)
+    else:
+        journal = open_journal(job_name, fingerprint)
+        skip_ids = set(journal.completed) if journal is not None else None
+        image_list = get_image_list()
+        store = open_tensor_store(CelebASpoofDetector, image_list)
+        if store is not None:
+            image_iter = iter_tensor_store(
+                store, CelebASpoofDetector,
+                lambda: get_image(cache=cache, skip_ids=skip_ids, batch_policy=batch_policy, image_list=image_list,
+                                  prefetch_depth=PREFETCH_DEPTH),
+                batch_policy, skip_ids)
+        else:
+            image_iter = get_image(cache=cache, skip_ids=skip_ids, batch_policy=batch_policy, image_list=image_list,
+                                   prefetch_depth=PREFETCH_DEPTH)
+        # batches are yielded from buffers sized for this depth
+        celebA_spoof_image_iter = PrefetchIterator(image_iter, PREFETCH_DEPTH, start=not AUTOTUNE)
+        evaluate_runtime(CelebASpoofDetector, celebA_spoof_image_iter, job_name, cache, journal, batch_policy)
 
 
 
@@ -0,0 +1,93 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from eval_kit.batching import BatchBuffer, BatchPolicy
+from eval_kit.client import iter_images
+from eval_kit.prefetch import PrefetchIterator
+from eval_kit.storage import MemoryStorage
+
+SHAPE = (32, 32, 3)
+
+
+def make_storage(count):
+    # every image is filled with its own index, so a batch shows which image ended up in which slot
+    storage = MemoryStorage()
+    image_ids = []
+    for idx in range(count):
+        image_id = 'x{:02d}.png'.format(idx)
+        storage.put(image_id, cv2.imencode('.png', np.full(SHAPE, idx, dtype=np.uint8))[1].tobytes())
+        image_ids.append(image_id)
+    return storage, image_ids
+
+
+def check_batch(image_ids, images):
+    for image_id, image in zip(image_ids, images):
+        assert image.shape == SHAPE
+        assert (image == int(image_id[1:3])).all(), "{} holds the pixels of another image".format(image_id)
+
+
+def budget_policy(images_per_batch):
+    return BatchPolicy(1024, memory_budget=images_per_batch * int(np.prod(SHAPE)), activation_bytes=0)
+
+
+@pytest.mark.parametrize('decode_workers', [0, 2])
+def test_budget_cut_batches_survive_slow_consumer(decode_workers):
+    storage, image_ids = make_storage(40)
+    depth = 2
+    batches = PrefetchIterator(iter_images(storage, image_ids, '', workers=4, batch_policy=budget_policy(2),
+                                           decode_workers=decode_workers, prefetch_depth=depth), depth)
+    seen = []
+    for batch_ids, images in batches:
+        # the producer runs ahead and fills the queue while this batch is scored
+        time.sleep(0.05)
+        check_batch(batch_ids, images)
+        seen.extend(batch_ids)
+    assert seen == image_ids
+
+
+def test_batches_can_be_kept_without_prefetch():
+    storage, image_ids = make_storage(12)
+    batches = list(iter_images(storage, image_ids, '', workers=4, batch_policy=BatchPolicy(1, memory_budget=0)))
+    assert len(batches) == 12
+    for batch_ids, images in batches:
+        check_batch(batch_ids, images)
+
+
+def test_buffer_keeps_returned_batches_for_its_slots():
+    slots = 3
+    buffer = BatchBuffer(budget_policy(2), ingest_size=None, slots=slots)
+    returned = []
+    for idx in range(20):
+        for batch in buffer.add('x{:02d}'.format(idx), np.full(SHAPE, idx, dtype=np.uint8)):
+            returned.append(batch)
+            # the last slots - 1 batches returned are all intact
+            for batch_ids, images in returned[-(slots - 1):]:
+                check_batch(batch_ids, images)
+
+
+def test_budget_cut_pixels_with_mixed_shapes_and_retuned_policy():
+    # images of two sizes, so the budget closes batches after a varying number of images
+    storage = MemoryStorage()
+    image_ids = []
+    for idx in range(30):
+        size = 32 if idx % 3 else 48
+        image_id = 'x{:02d}.png'.format(idx)
+        storage.put(image_id, cv2.imencode('.png', np.full((size, size, 3), idx, dtype=np.uint8))[1].tobytes())
+        image_ids.append(image_id)
+    policy = budget_policy(3)
+    depth = 1
+    batches = PrefetchIterator(iter_images(storage, image_ids, '', workers=4, batch_policy=policy,
+                                           prefetch_depth=depth), depth)
+    seen = []
+    for batch_ids, images in batches:
+        # like an autotune, the policy changes while the iterator runs
+        policy.max_batch_size = 2 if policy.max_batch_size > 2 else 1024
+        time.sleep(0.05)
+        assert sum(image.nbytes for image in images) <= policy.memory_budget or len(batch_ids) == 1
+        for image_id, image in zip(batch_ids, images):
+            assert (image == int(image_id[1:3])).all(), "{} holds the pixels of another image".format(image_id)
+        seen.extend(batch_ids)
+    assert seen == image_ids
@@ -0,0 +1,10 @@
+"""
+Command line tools of the evaluation toolkit, run from the repository root as modules:
+
+    python -m tools.<name> --help
+
+Like run_evaluation.py, they import the detector from the model directory.
+"""
+import sys
+
+sys.path.append('model')
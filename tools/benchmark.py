@@ -0,0 +1,153 @@
+"""
+Offline throughput benchmark of AENetPredictor and the local image loader.
+
+Synthetic RGB face crops of realistic sizes are generated once with a fixed seed, then
+    - the predictor is swept over --modes, --batch-sizes and --threads, feeding it the
+      batches the loader would produce: --batch-sizes images of mixed sizes each, and
+    - the image iterator is swept over --batch-sizes on the same crops encoded as PNG files,
+      read from memory (MemoryStorage) and from a local directory (LocalStorage).
+Images/s and per-batch latency percentiles are printed and saved to --output as json,
+so configurations can be compared reproducibly across CPU-only hosts:
+
+    python -m tools.benchmark --modes fp32 fp32-eager int8 onnx --batch-sizes 16 64 256 --threads 1 4 8
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from eval_kit import client
+from eval_kit.batching import BatchBuffer, BatchPolicy
+from eval_kit.metrics import Metrics
+from eval_kit.storage import LocalStorage, MemoryStorage
+from predictor import AENetPredictor, ONNXPredictor
+
+logging.basicConfig(level=logging.INFO)
+
+# (height, width) of the synthetic crops, drawn uniformly
+CROP_SIZES = [(224, 224), (256, 200), (320, 256), (400, 320), (512, 400), (640, 480)]
+MODES = ('fp32', 'fp32-eager', 'int8', 'onnx')
+
+
+def synthetic_crops(count, seed=0):
+    rng = np.random.RandomState(seed)
+    images = []
+    for idx in range(count):
+        height, width = CROP_SIZES[rng.randint(len(CROP_SIZES))]
+        # smooth noise compresses and resizes more like a photo than white noise
+        small = rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8)
+        images.append(('synthetic_{:06d}.png'.format(idx), cv2.resize(small, (width, height))))
+    return images
+
+
+def make_predictor(mode, num_threads):
+    if mode == 'onnx':
+        return ONNXPredictor(num_threads=num_threads)
+    if mode == 'fp32-eager':
+        return AENetPredictor(device='cpu', num_threads=num_threads, mode='fp32', torchscript=False)
+    return AENetPredictor(device='cpu', num_threads=num_threads, mode=mode)
+
+
+def batches(images, batch_size):
+    buffer = BatchBuffer(batch_size)
+    for image_id, image in images:
+        for batch in buffer.add(image_id, image):
+            yield batch
+    for batch in buffer.flush():
+        yield batch
+
+
+def summarise(config, recorder, stage, batch_sizes):
+    stats = recorder.report()['stages'][stage]
+    # the sizes actually fed, the last batch of a run is usually partial
+    result = dict(config, batches=len(batch_sizes), max_batch=max(batch_sizes),
+                  mean_batch=sum(batch_sizes) / len(batch_sizes), **stats)
+    logging.info("{}: {images_per_s:.1f} images/s, {batches} batches of {mean_batch:.1f} images on average, "
+                 "batch p50 {p50_ms:.1f}ms p95 {p95_ms:.1f}ms p99 {p99_ms:.1f}ms".format(json.dumps(config), **result))
+    return result
+
+
+def bench_predictor(images, mode, batch_size, num_threads, warmup):
+    predictor = make_predictor(mode, num_threads)
+    for _, batch in batches(images[:warmup], batch_size):
+        predictor.predict(batch)
+    recorder = Metrics()
+    batch_sizes = []
+    for _, batch in batches(images, batch_size):
+        # the buffer is recycled, keep the timing on the predictor only
+        with recorder.time('predict', len(batch)):
+            predictor.predict(batch)
+        batch_sizes.append(len(batch))
+    config = {'bench': 'predict', 'mode': mode, 'batch_size': batch_size, 'threads': num_threads}
+    return summarise(config, recorder, 'predict', batch_sizes)
+
+
+def bench_loader(storage, image_ids, batch_size):
+    recorder = Metrics()
+    batch_sizes = []
+    iterator = client.iter_images(storage, image_ids, '', batch_policy=BatchPolicy(batch_size))
+    while True:
+        st = time.time()
+        batch = next(iterator, None)
+        if batch is None:
+            break
+        recorder.record('load', time.time() - st, len(batch[0]))
+        batch_sizes.append(len(batch[0]))
+    config = {'bench': 'iter_images', 'storage': type(storage).__name__, 'batch_size': batch_size}
+    return summarise(config, recorder, 'load', batch_sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=512, help='number of synthetic crops')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=['fp32'])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[16, 64, 256])
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()])
+    parser.add_argument('--warmup', type=int, default=32, help='images scored before timing each configuration')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-loader', action='store_true')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    images = synthetic_crops(args.images, args.seed)
+    results = []
+    for mode in args.modes:
+        for num_threads in args.threads:
+            for batch_size in args.batch_sizes:
+                results.append(bench_predictor(images, mode, batch_size, num_threads, args.warmup))
+
+    if not args.skip_loader:
+        image_ids = [image_id for image_id, _ in images]
+        memory = MemoryStorage()
+        for image_id, image in images:
+            memory.put(image_id, cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes())
+        with tempfile.TemporaryDirectory() as image_dir:
+            for image_id in image_ids:
+                with open(os.path.join(image_dir, image_id), 'wb') as f:
+                    f.write(memory.read(image_id))
+            for storage in (memory, LocalStorage(image_dir)):
+                for batch_size in args.batch_sizes:
+                    results.append(bench_loader(storage, image_ids, batch_size))
+
+    host = {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'host': host, 'images': args.images, 'seed': args.seed, 'results': results}, f, indent=2)
+    logging.info("Saved {} results to {}".format(len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Numerical parity checks between the reference inference path and its optimised variants.
+
+Every check runs both paths on the same images (by default the local test images) and
+reports the largest differences. The script exits with a non-zero status when a
+difference exceeds the tolerance, so it can be used as a regression gate:
+
+    python -m tools.check_parity preprocess
+    python -m tools.check_parity fusion
+    python -m tools.check_parity torchscript
+    python -m tools.check_parity onnx
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from eval_kit.client import read_image, LOCAL_IMAGE_LIST_PATH, LOCAL_IMAGE_PREFIX
+from predictor import AENetPredictor, ONNXPredictor
+
+logging.basicConfig(level=logging.INFO)
+
+CHECKS = {}
+
+
+def check(name):
+    def register(func):
+        CHECKS[name] = func
+        return func
+    return register
+
+
+def load_images(image_list_path, image_prefix):
+    image_ids = [x.strip() for x in open(image_list_path) if x.strip()]
+    images = [read_image(os.path.join(image_prefix, image_id)) for image_id in image_ids]
+    return image_ids, images
+
+
+def compare(name, reference, candidate, atol):
+    """
+    Log the largest absolute difference between two arrays, return whether it is within atol.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    diff = np.abs(reference - candidate)
+    max_diff = float(diff.max()) if diff.size else 0.0
+    ok = max_diff <= atol
+    logging.info("{}: max abs diff {:.3g}, mean abs diff {:.3g}, atol {:.3g} -> {}".format(
+        name, max_diff, float(diff.mean()) if diff.size else 0.0, atol, 'OK' if ok else 'FAIL'))
+    return ok
+
+
+@check('preprocess')
+def check_preprocess(args, image_ids, images):
+    """
+    Batched tensor preprocessing against the per-image PIL transform.
+    """
+    predictor = AENetPredictor()
+    reference = torch.stack([predictor.preprocess_data(image) for image in images], dim=0)
+    candidate = predictor.preprocess_batch(images)
+    ok = compare('preprocessed input', reference.numpy(), candidate.numpy(), 1.0 / 255 + 1e-6)
+
+    predictor.preprocess = 'pil'
+    reference_prob = predictor.predict(images)
+    predictor.preprocess = 'tensor'
+    candidate_prob = predictor.predict(images)
+    return compare('spoof probability', reference_prob[:, 1], candidate_prob[:, 1], args.atol) and ok
+
+
+def timed_forward(predictor, data, repeat):
+    """
+    Return the logits of predictor.eval_image and its mean latency in seconds.
+    """
+    rst = predictor.eval_image(data)
+    st = time.time()
+    for _ in range(repeat):
+        predictor.eval_image(data)
+    return rst, (time.time() - st) / repeat
+
+
+@check('fusion')
+def check_fusion(args, image_ids, images):
+    """
+    AENet with BatchNorm folded into the convolutions against the unfused network.
+    """
+    reference = AENetPredictor(fuse_bn=False, torchscript=False)
+    candidate = AENetPredictor(fuse_bn=True, torchscript=False)
+    data = reference.preprocess_batch(images)
+    reference_rst, reference_time = timed_forward(reference, data, args.repeat)
+    candidate_rst, candidate_time = timed_forward(candidate, data, args.repeat)
+    logging.info("forward latency per batch: unfused {:.4f}s, fused {:.4f}s".format(reference_time, candidate_time))
+    ok = compare('logits', reference_rst.cpu().numpy(), candidate_rst.cpu().numpy(), 1e-3)
+    reference_prob = torch.softmax(reference_rst, dim=1).cpu().numpy()
+    candidate_prob = torch.softmax(candidate_rst, dim=1).cpu().numpy()
+    return compare('spoof probability', reference_prob[:, 1], candidate_prob[:, 1], args.atol) and ok
+
+
+@check('torchscript')
+def check_torchscript(args, image_ids, images):
+    """
+    Frozen TorchScript artifact against the eager network.
+    """
+    reference = AENetPredictor(torchscript=False)
+    candidate = AENetPredictor(torchscript=True)
+    data = reference.preprocess_batch(images)
+    reference_rst, reference_time = timed_forward(reference, data, args.repeat)
+    candidate_rst, candidate_time = timed_forward(candidate, data, args.repeat)
+    logging.info("forward latency per batch: eager {:.4f}s, torchscript {:.4f}s".format(reference_time, candidate_time))
+    reference_prob = torch.softmax(reference_rst, dim=1).cpu().numpy()
+    candidate_prob = torch.softmax(candidate_rst, dim=1).cpu().numpy()
+    return compare('spoof probability', reference_prob[:, 1], candidate_prob[:, 1], args.atol)
+
+
+@check('onnx')
+def check_onnx(args, image_ids, images):
+    """
+    ONNX Runtime on CPU against the PyTorch predictor on CPU, including the predict output contract.
+    """
+    reference = AENetPredictor(device='cpu', torchscript=False)
+    candidate = ONNXPredictor()
+    data = reference.preprocess_batch(images)
+    reference_rst, reference_time = timed_forward(reference, data, args.repeat)
+    candidate_rst, candidate_time = timed_forward(candidate, data, args.repeat)
+    logging.info("throughput: pytorch {:.1f} images/s, onnxruntime {:.1f} images/s".format(
+        len(images) / reference_time, len(images) / candidate_time))
+
+    reference_prob = reference.predict(images)
+    candidate_prob = candidate.predict(images)
+    if candidate_prob.shape != (len(images), 2):
+        logging.info("ONNXPredictor.predict returned shape {}, expected {}".format(candidate_prob.shape, (len(images), 2)))
+        return False
+    ok = compare('logits', reference_rst.numpy(), candidate_rst.numpy(), 1e-3)
+    return compare('spoof probability', reference_prob[:, 1], candidate_prob[:, 1], args.atol) and ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('check', choices=sorted(CHECKS))
+    parser.add_argument('--image-list', default=LOCAL_IMAGE_LIST_PATH)
+    parser.add_argument('--image-prefix', default=LOCAL_IMAGE_PREFIX)
+    parser.add_argument('--atol', type=float, default=1e-3, help='tolerance on the spoof probability')
+    parser.add_argument('--repeat', type=int, default=10, help='forward passes timed per path')
+    args = parser.parse_args()
+
+    image_ids, images = load_images(args.image_list, args.image_prefix)
+    logging.info("Running {} parity check on {} images".format(args.check, len(images)))
+    ok = CHECKS[args.check](args, image_ids, images)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Convert the training checkpoint into the inference-only weights file read by AENetPredictor.
+
+The output keeps only the live/spoof path of AENet: no optimizer state, no 'module.'
+prefixes and no auxiliary heads. BatchNorm is folded into the convolutions unless
+--no-fuse-bn is given. Tensors are stored in a flat layout (see model/weights.py) that
+is memory-mapped at load time, so worker processes share one copy of the weights:
+
+    python -m tools.convert_checkpoint [--checkpoint model/ckpt_iter_27000.pth.tar]
+"""
+import argparse
+import logging
+import os
+
+import torch
+
+from fuse import fuse_aenet
+from models import AENet
+from predictor import CHECKPOINT_PATH, WEIGHTS_PATH, pretrain
+from weights import save_flat_weights
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--output', default=WEIGHTS_PATH)
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--no-fuse-bn', dest='fuse_bn', action='store_false')
+    args = parser.parse_args()
+
+    net = AENet(num_classes=args.num_classes, inference_only=True)
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    pretrain(net, checkpoint['state_dict'])
+    net.eval()
+    if args.fuse_bn:
+        fuse_aenet(net)
+
+    meta = {'fused': args.fuse_bn, 'num_classes': args.num_classes,
+            'checkpoint': os.path.basename(args.checkpoint)}
+    save_flat_weights(net.state_dict(), args.output, meta)
+    logging.info("Wrote {} tensors ({} bytes) to {}".format(
+        len(net.state_dict()), os.path.getsize(args.output), args.output))
+
+
+if __name__ == '__main__':
+    main()
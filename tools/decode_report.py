@@ -0,0 +1,84 @@
+"""
+Measure the cost and the accuracy impact of reduced-resolution decoding (CELEBASPOOF_REDUCED_DECODE).
+
+Every image of --image-list is decoded at full size and at the reduced scale picked for
+--min-size, and both versions are scored by AENetPredictor. The decode time, the decoded
+pixel bytes held by a batch, the score drift and, with --labels, the ACER change are
+printed and optionally written to --report:
+
+    python -m tools.decode_report --image-list list.txt --image-prefix /data/ --labels labels.json
+
+Only images at least twice --min-size on both sides are reduced, the others score the same.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from eval_kit.client import decode_image, LOCAL_IMAGE_LIST_PATH, LOCAL_IMAGE_PREFIX, LOCAL_LABEL_LIST_PATH
+from eval_kit.report import score_drift
+from predictor import AENetPredictor
+
+logging.basicConfig(level=logging.INFO)
+
+
+def decode_all(encoded, min_size):
+    """
+    return:
+    - list of decoded images
+    - total decode seconds
+    """
+    st = time.time()
+    images = [decode_image(data, min_size=min_size) for data in encoded]
+    return images, time.time() - st
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image-list', default=LOCAL_IMAGE_LIST_PATH)
+    parser.add_argument('--image-prefix', default=LOCAL_IMAGE_PREFIX)
+    parser.add_argument('--labels', default=LOCAL_LABEL_LIST_PATH, help='json of {image_id: label}, 1 is spoof')
+    parser.add_argument('--min-size', type=int, default=224, help='smallest side kept by the reduced decode')
+    parser.add_argument('--report', help='write the report as json to this path')
+    args = parser.parse_args()
+
+    image_ids = [x.strip() for x in open(args.image_list) if x.strip()]
+    encoded = []
+    for image_id in image_ids:
+        with open(os.path.join(args.image_prefix, image_id), 'rb') as f:
+            encoded.append(f.read())
+
+    full, full_s = decode_all(encoded, 0)
+    reduced, reduced_s = decode_all(encoded, args.min_size)
+    reduced_count = sum(a.shape != b.shape for a, b in zip(full, reduced))
+    logging.info("{} of {} images decoded at a reduced scale".format(reduced_count, len(image_ids)))
+
+    predictor = AENetPredictor()
+    full_probs = np.array([predictor.predict([image])[0, 1] for image in full])
+    reduced_probs = np.array([predictor.predict([image])[0, 1] for image in reduced])
+    labels = None
+    if args.labels:
+        with open(args.labels) as f:
+            gts = json.load(f)
+        labels = [gts[image_id] for image_id in image_ids]
+
+    report = score_drift(full_probs, reduced_probs, labels)
+    report.update({
+        'min_size': args.min_size,
+        'reduced_images': reduced_count,
+        'full_decode_ms_per_image': 1000 * full_s / len(image_ids),
+        'reduced_decode_ms_per_image': 1000 * reduced_s / len(image_ids),
+        'full_decoded_bytes': int(sum(image.nbytes for image in full)),
+        'reduced_decoded_bytes': int(sum(image.nbytes for image in reduced)),
+    })
+    logging.info("reduced vs full decode on {} images: {}".format(len(image_ids), json.dumps(report, indent=2)))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Export AENet as a deployment artifact ahead of time.
+
+    python -m tools.export_model torchscript [--device cpu]
+    python -m tools.export_model onnx
+
+writes the frozen TorchScript model that AENetPredictor loads at start-up instead of
+rebuilding the network from the checkpoint, or the ONNX graph run by ONNXPredictor.
+Artifacts are used as long as they are newer than the checkpoint, so re-run the export
+after updating the weights.
+"""
+import argparse
+import logging
+
+from export import export_onnx, export_torchscript
+from predictor import AENetPredictor, ONNX_PATH, TORCHSCRIPT_PATH
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('format', choices=['torchscript', 'onnx'])
+    parser.add_argument('--device', help='device the artifact is optimised for, defaults to the predictor default')
+    parser.add_argument('--no-fuse-bn', dest='fuse_bn', action='store_false')
+    parser.add_argument('--output', help='destination, defaults to the path AENetPredictor loads from')
+    args = parser.parse_args()
+
+    if args.format == 'onnx':
+        predictor = AENetPredictor(device='cpu', fuse_bn=args.fuse_bn, mode='fp32', torchscript=False)
+        export_onnx(predictor.net, args.output or ONNX_PATH, predictor.new_width)
+        return
+
+    predictor = AENetPredictor(device=args.device, fuse_bn=args.fuse_bn, mode='fp32', torchscript=False)
+    output = args.output or TORCHSCRIPT_PATH.format(fused='fused' if args.fuse_bn else 'unfused',
+                                                    device=predictor.device.type)
+    export_torchscript(predictor.net, output, predictor.new_width, predictor.device)
+
+
+if __name__ == '__main__':
+    main()
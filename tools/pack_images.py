@@ -0,0 +1,45 @@
+"""
+Bundle the images of a list into a few large pack files with an offset index (see eval_kit.packs).
+
+The images are read from --storage (a local directory laid out like the workspace bucket, or
+the bucket itself) and written to --output-dir, to be uploaded next to the image list:
+
+    python -m tools.pack_images --storage-root /data/workspace --output-dir /data/workspace/packs
+    aws s3 sync /data/workspace/packs s3://celeba-spoof-eval-workspace/packs
+
+The evaluation then reads the packs instead of one object per image with
+CELEBASPOOF_PACK_INDEX=packs/<name>.index.json.
+"""
+import argparse
+import logging
+import os
+
+from eval_kit import client
+from eval_kit.packs import PACK_SIZE, write_packs
+from eval_kit.storage import LocalStorage
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', choices=['local', 's3'], default='local')
+    parser.add_argument('--storage-root', default='.', help='directory of the local storage')
+    parser.add_argument('--image-list', default=client.IMAGE_LIST_PATH, help='key of the image list')
+    parser.add_argument('--image-prefix', default=client.IMAGE_PREFIX, help='key prefix of the images')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--name', help='defaults to the name of the image list')
+    parser.add_argument('--pack-size', type=int, default=PACK_SIZE, help='target size of a pack in bytes')
+    args = parser.parse_args()
+
+    if args.storage == 'local':
+        storage = LocalStorage(args.storage_root)
+    else:
+        storage = client.open_storage('s3')
+    name = args.name or os.path.splitext(os.path.basename(args.image_list))[0]
+    keys = [os.path.join(args.image_prefix, image_id) for image_id in storage.read_lines(args.image_list)]
+    write_packs(((key, storage.read(key)) for key in keys), args.output_dir, name, args.pack_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Build the int8 AENet used by AENetPredictor(mode='int8') and report its accuracy impact.
+
+The float network is quantized with post-training static quantization, calibrated on the
+images of --calibration-list, and saved as TorchScript to model/aenet_int8.pt. The fp32
+and int8 predictors are then run on --eval-list and the score drift, together with the
+ACER change when --labels is given, is printed and optionally written to --report:
+
+    python -m tools.quantize_model --calibration-list calib.txt --calibration-prefix /data/ \\
+        --eval-list test_data/test_example.txt --labels test_data/test_example_label.json
+"""
+import argparse
+import json
+import logging
+
+import numpy as np
+import torch
+
+from eval_kit.client import LOCAL_IMAGE_LIST_PATH, LOCAL_IMAGE_PREFIX, LOCAL_LABEL_LIST_PATH
+from eval_kit.report import score_drift
+from tools.check_parity import load_images
+from predictor import AENetPredictor, INT8_PATH
+from quantize import quantize_static, save_quantized
+
+logging.basicConfig(level=logging.INFO)
+
+
+def calibration_batches(predictor, images, batch_size):
+    for start in range(0, len(images), batch_size):
+        yield predictor.preprocess_batch(images[start:start + batch_size])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calibration-list', required=True, help='image list used to calibrate activations')
+    parser.add_argument('--calibration-prefix', default='')
+    parser.add_argument('--eval-list', default=LOCAL_IMAGE_LIST_PATH)
+    parser.add_argument('--eval-prefix', default=LOCAL_IMAGE_PREFIX)
+    parser.add_argument('--labels', default=LOCAL_LABEL_LIST_PATH, help='json of {image_id: label}, 1 is spoof')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--output', default=INT8_PATH)
+    parser.add_argument('--report', help='write the drift report as json to this path')
+    args = parser.parse_args()
+
+    fp32 = AENetPredictor(device='cpu', mode='fp32', fuse_bn=False, torchscript=False)
+    _, calibration_images = load_images(args.calibration_list, args.calibration_prefix)
+    qnet = quantize_static(fp32.net, calibration_batches(fp32, calibration_images, args.batch_size))
+    save_quantized(qnet, args.output, size=fp32.new_width)
+    logging.info("Saved int8 AENet to {}".format(args.output))
+
+    image_ids, images = load_images(args.eval_list, args.eval_prefix)
+    # score the model just saved, not whatever AENetPredictor(mode='int8') finds at INT8_PATH
+    int8 = AENetPredictor(mode='int8', net=torch.jit.load(args.output, map_location='cpu'))
+    fp32_probs = np.concatenate([fp32.predict(images[i:i + args.batch_size])[:, 1]
+                                 for i in range(0, len(images), args.batch_size)])
+    int8_probs = np.concatenate([int8.predict(images[i:i + args.batch_size])[:, 1]
+                                 for i in range(0, len(images), args.batch_size)])
+    labels = None
+    if args.labels:
+        with open(args.labels) as f:
+            gts = json.load(f)
+        labels = [gts[image_id] for image_id in image_ids]
+
+    report = score_drift(fp32_probs, int8_probs, labels)
+    logging.info("int8 vs fp32 on {} images: {}".format(len(images), json.dumps(report, indent=2)))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()